@@ -6,7 +6,7 @@ v1.0
 
 expects file structure as
 
-main_excel_file.xlsx
+main_excel_file.xlsx (or a CSV export of its first sheet)
   |
   |--Image Dir 01
   |       |--images01.jpg
@@ -26,49 +26,363 @@ v1.0 28/05/2013 markg@ivec.org
 import os
 import os.path
 import argparse
+import array
+import csv
+import hashlib
+import shutil
+import tempfile
+import zipfile
+from collections import OrderedDict, deque
 
+import numpy as np
 from openpyxl.reader.excel import load_workbook
-from PIL import Image
-from PIL.ExifTags import TAGS
+
+from catami_common import ImagesFileWriter, metadata_pool, harvest_metadata
 
 parser = argparse.ArgumentParser(description='Parse AIMS TI data to produce valid Catami project.')
 parser.add_argument('--path', nargs=1, help='Path to TI data directory')
 parser.add_argument('--deployment', action='store_true', default=False, help='Convert the directory as a deployment, to be attached to an existing campaign')
-parser.add_argument('--spreadsheet', nargs=1, help='Path to root XLSX file for campaign')
+parser.add_argument('--spreadsheet', nargs=1, help='Path to root XLSX file for campaign (or a CSV export of its first sheet)')
+parser.add_argument('--no_cache', action='store_true', default=False, help='Read the spreadsheet and the EXIF data of every image again instead of using the caches.')
+parser.add_argument('--workers', nargs=1, type=int, help='Number of images to read EXIF data from at once (default 8, more can help on network storage)')
 args = parser.parse_args()
 
 images_filename = 'images.csv'
+images_headers = ['Time', 'Latitude', 'Longitude', 'Depth', 'ImageName', 'CameraName', 'CameraAngle', 'Temperature (celcius)',
+                  'Salinity (psu)', 'Pitch (radians)', 'Roll (radians)', 'Yaw (radians)', 'Altitude (metres)']
 description_filename = 'description.txt'
 
 #version 1.0 format described at https://github.com/catami/catami/wiki/Data-importing
 current_format_version = '1.0'
 fill_value = -999.
 
+# the spreadsheet columns used, A to I
+spreadsheet_columns = 9
+spreadsheet_chunk_size = 1024 * 1024
+# rows whose cache indices are gathered before they are written out to disk
+cache_batch_rows = 4096
+# folders whose camera sample is being read while an earlier folder is written
+sample_lookahead = 4
+
+
+def cell_text(value):
+    """a spreadsheet value as it is written to images.csv, None or a string
+    """
+    if value is None or isinstance(value, basestring):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    return unicode(value)
+
+
+def read_workbook(path):
+    """the rows of Sheet1 of an XLSX workbook, each a tuple of the text of its first nine columns
+        A generator, the sheet is streamed a row at a time and the cells past column I are never made.
+    """
+    wb = load_workbook(filename=path, use_iterators=True)
+    ws = wb.get_sheet_by_name(name='Sheet1')
+
+    for row in ws.iter_rows('A1:I%d' % ws.get_highest_row()):
+        row = [cell_text(cell.internal_value) for cell in row]
+        yield tuple(row + [None] * (spreadsheet_columns - len(row)))
+
+
+def read_csv_sheet(path):
+    """the rows of a CSV export of the spreadsheet, as read_workbook gives them
+        Empty cells are None, as they are in the workbook. The byte order mark Excel puts at the
+        start of a "CSV UTF-8" export is dropped.
+    """
+    with open(path, 'rb') as f:
+        for line_number, row in enumerate(csv.reader(f)):
+            if not row:
+                continue
+            row = [value.decode('utf-8-sig' if line_number == 0 and column == 0 else 'utf-8') if value else None
+                   for column, value in enumerate(row[:spreadsheet_columns])]
+            yield tuple(row + [None] * (spreadsheet_columns - len(row)))
+
+
+def file_sha1(path):
+    """the hex sha1 of a file's contents
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(spreadsheet_chunk_size), ''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def sheet_cache_path(path):
+    """the hidden columnar cache kept beside a workbook
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.' + name + '.npz')
+
+
+def load_sheet_cache(cache_path, sha1):
+    """the rows kept by caching_rows, or None if there are none for a workbook with this sha1
+        Only the string table and index matrix are held, the rows are made as they are iterated.
+    """
+    try:
+        with np.load(cache_path) as cache:
+            if str(cache['sha1']) != sha1:
+                return None
+            table = cache['table'].tolist()
+            codes = cache['codes']
+    except (IOError, ValueError, KeyError, zipfile.BadZipfile):
+        return None
 
-def get_camera_makemodel(image_name):
-    """Returns a camera make and model from the exif data of an PIL Image item."""
-    image = Image.open(image_name)
-    info = image._getexif()
-    if info:
-        make = ''
-        model = ''
-        for tag, value in info.items():
-            decoded = TAGS.get(tag, tag)
-            if decoded == "Model":
-                model = value
-            if decoded == "Make":
-                make = value
-        make_model_string = make+model
+    return (tuple(None if code < 0 else table[code] for code in row.tolist()) for row in codes)
+
+
+def caching_rows(rows, cache_path, sha1):
+    """passes rows through, keeping them as a table of their distinct strings and a matrix of indices
+        into it (-1 for empty), which is saved at cache_path once the last row has been read.
+        The table is held in memory, so this grows with the distinct text of the sheet (every image path
+        is distinct). The indices go to a temporary file cache_batch_rows at a time and are copied into
+        the cache from there. The cache is written to a temporary file of its own and renamed, so it is
+        never left half written.
+    """
+    directory, name = os.path.split(cache_path)
+    index = {}
+    count = 0
+    codes = array.array('i')
+    try:
+        codes_file = tempfile.TemporaryFile(dir=directory or '.', prefix=name + '.')
+    except (IOError, OSError), e:
+        print 'WARNING: Could not save the spreadsheet cache', cache_path, '-', e
+        codes_file = None
+
+    for row in rows:
+        if codes_file is not None:
+            codes.extend(-1 if text is None else index.setdefault(text, len(index)) for text in row)
+            count += 1
+            if count % cache_batch_rows == 0:
+                try:
+                    codes.tofile(codes_file)
+                except (IOError, OSError), e:
+                    print 'WARNING: Could not save the spreadsheet cache', cache_path, '-', e
+                    codes_file.close()
+                    codes_file = None
+                codes = array.array('i')
+        yield row
+
+    if codes_file is None:
+        return
+
+    table = [None] * len(index)
+    for text, code in index.items():
+        table[code] = text
+    index = None
+
+    try:
+        codes.tofile(codes_file)
+        codes_file.flush()
+        if count > 0:
+            codes = np.memmap(codes_file, dtype=np.int32, mode='r', shape=(count, spreadsheet_columns))
+        else:
+            codes = np.zeros((0, spreadsheet_columns), dtype=np.int32)
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory or '.', prefix=name + '.')
+        with os.fdopen(descriptor, 'wb') as f:
+            np.savez(f, sha1=np.array(sha1), table=np.array(table, dtype=unicode), codes=codes)
+        os.rename(temporary_path, cache_path)
+    except (IOError, OSError), e:
+        print 'WARNING: Could not save the spreadsheet cache', cache_path, '-', e
+    finally:
+        codes = None
+        codes_file.close()
+
+
+def read_spreadsheet(path, use_cache=True):
+    """the rows of the spreadsheet, each a tuple of the text (or None) of its first nine columns
+        A generator over a CSV export, the cache or the workbook.
+        The rows of a workbook are cached beside it (see caching_rows), keyed by the workbook's sha1, so
+        later runs on the same workbook skip parsing the XLSX.
+    """
+    if path.lower().endswith('.csv'):
+        return read_csv_sheet(path)
+
+    cache_path = sheet_cache_path(path)
+    sha1 = file_sha1(path)
+    if use_cache:
+        rows = load_sheet_cache(cache_path, sha1)
+        if rows is not None:
+            print 'MESSAGE: Using the cached rows of', path
+            return rows
+
+    return caching_rows(read_workbook(path), cache_path, sha1)
+
+
+def get_camera_makemodel(metadata):
+    """Returns a camera make and model from the metadata of read_image_metadata."""
+    if metadata['exif']:
+        make_model_string = (metadata['make'] or '')+(metadata['model'] or '')
     else:
         make_model_string = 'null'
 
     return make_model_string
 
+def start_camera_sample(pool, root_import_path, image_folder, image_names):
+    """starts reading the metadata of the first, middle and last images of a folder
+    """
+    sample = sorted(set([0, len(image_names) / 2, len(image_names) - 1]))
+    return harvest_metadata(pool, [os.path.join(root_import_path, image_folder, image_names[index]) for index in sample],
+                            use_cache=not args.no_cache)
+
+
+def folder_cameras(pool, root_import_path, image_folder, image_names, sample):
+    """the camera name of each image in a folder
+        A transect is shot with one camera, so if the images sampled by start_camera_sample agree that
+        camera is used for all of them. Otherwise every image's EXIF data is read.
+    """
+    camera_names = set(get_camera_makemodel(metadata) for metadata in sample.get())
+    if len(camera_names) == 1:
+        return [camera_names.pop()] * len(image_names)
+
+    print 'WARNING: More than one camera in', image_folder, '- reading the camera of every image.'
+    image_metadata = harvest_metadata(pool, [os.path.join(root_import_path, image_folder, image_name) for image_name in image_names],
+                                      use_cache=not args.no_cache).get()
+
+    return [get_camera_makemodel(metadata) for metadata in image_metadata]
+
+
+def folder_runs(rows):
+    """the spreadsheet rows as runs of consecutive rows of one transect folder, each
+        (folder, list of (image name, row)). A generator, only the run being gathered is held.
+    """
+    image_folder = None
+    entries = []
+    for row in rows:
+        if (row[0] == 'OBSFILE'):
+            continue
+        split_path = row[1].split("\\")
+        if split_path[-2] != image_folder and entries:
+            yield image_folder, entries
+            entries = []
+        image_folder = split_path[-2]
+        entries.append((split_path[-1], row))
+
+    if entries:
+        yield image_folder, entries
+
+
+def sampled_runs(pool, root_import_path, runs, spill):
+    """the runs of folder_runs, each with its camera sample (see start_camera_sample) started
+        sample_lookahead folders ahead, so the EXIF reads of the next folders overlap writing this one.
+        A run of a folder met before, further up the spreadsheet, is handed to spill instead.
+    """
+    seen = set()
+    ahead = deque()
+    for image_folder, entries in runs:
+        if image_folder in seen:
+            spill.add(image_folder, entries)
+            continue
+        seen.add(image_folder)
+        ahead.append((image_folder, entries, start_camera_sample(pool, root_import_path, image_folder, [image_name for image_name, row in entries])))
+        if len(ahead) > sample_lookahead:
+            yield ahead.popleft()
+
+    while ahead:
+        yield ahead.popleft()
+
+
+class RunSpill(object):
+    """Keeps the rows of folders whose rows are not all together in the spreadsheet.
+
+    The later runs of such a folder go to a temporary CSV file of their own
+    and are read back once the spreadsheet is finished, so the sheet never
+    has to be held or sorted. close() removes the files.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.paths = OrderedDict()
+
+    def add(self, image_folder, entries):
+        """Keep a run of a folder (a list of (image name, row))."""
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='catami_ti_')
+        if image_folder not in self.paths:
+            print 'WARNING: The rows of', image_folder, 'are not all together in the spreadsheet - adding the later ones at the end.'
+            self.paths[image_folder] = os.path.join(self.directory, '%d.csv' % len(self.paths))
+
+        with open(self.paths[image_folder], 'ab') as f:
+            writer = csv.writer(f)
+            writer.writerows([['' if text is None else text.encode('utf-8') for text in row] for image_name, row in entries])
+
+    def folders(self):
+        """The kept folders, each (folder, list of (image name, row)), one at a time."""
+        for image_folder, path in self.paths.items():
+            entries = []
+            for row in read_csv_sheet(path):
+                entries.append((row[1].split("\\")[-1], row))
+            yield image_folder, entries
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def read_images_rows(path):
+    """the rows of an images.csv made by write_folder, without the version and header lines
+    """
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        reader.next()
+        reader.next()
+        for row in reader:
+            yield row
+
+
+def write_folder(pool, root_import_path, image_folder, entries, sample, previous_rows=()):
+    """writes the description file (if there is none) and images.csv of a transect folder from its
+        spreadsheet rows, entries being a list of (image name, row). previous_rows are images.csv rows
+        put before those of entries.
+    """
+    image_names = [image_name for image_name, row in entries]
+    camera_names = folder_cameras(pool, root_import_path, image_folder, image_names, sample)
+
+    # make the description file if it doesn't exist
+    if not os.path.isfile(os.path.join(root_import_path, image_folder, description_filename)):
+        with open(os.path.join(root_import_path,image_folder, description_filename), "w") as f:
+            version_string = 'version:'+current_format_version+'\n'
+            f.write(version_string)
+            deployment_type_string = 'Type: TI\n'
+            f.write(deployment_type_string)
+            Description_string = 'Description:'+image_folder+' Transects\n'
+            f.write(Description_string)
+
+    # the whole images file in one go, any existing one is left as it was if this fails
+    with ImagesFileWriter(os.path.join(root_import_path, image_folder, images_filename), current_format_version, images_headers) as writer:
+        for previous_row in previous_rows:
+            writer.write(previous_row)
+
+        for (image_name, row), camera_name in zip(entries, camera_names):
+            obs_file_name = row[0]
+            image_original_file_path = row[1]
+            latitude = row[2]
+            longitude = row[3]
+            depth = row[4]
+            image_datetime = row[5]
+            record_datetime = row[6]
+            tag_string = row[7]
+            seagrass_cover = row[8]
+            camera_angle = 'Downward'
+            temperature = fill_value
+            salinity = fill_value
+            pitch_angle = fill_value
+            roll_angle = fill_value
+            yaw_angle = fill_value
+            altitude = fill_value
+
+            writer.write([unicode(image_datetime), latitude, longitude, depth, image_name, camera_name, camera_angle,
+                          temperature, salinity, pitch_angle, roll_angle, yaw_angle, altitude])
+
+    print 'Added ', writer.count, 'entries in', image_folder, ":", images_filename
+
+
 if __name__ == "__main__":
     root_import_path = args.spreadsheet[0].rsplit("/",1)[0]
-    wb = load_workbook(filename=args.spreadsheet[0], use_iterators=True)
-
-    ws = wb.get_sheet_by_name(name='Sheet1')
 
     # AIMS xlsx format
     # row[0] -> observation file (a csv file)
@@ -81,55 +395,22 @@ if __name__ == "__main__":
     # row[7] -> Tag (? blank in example data)
     # row[8] -> Seagrass Cover (? blank in example data)
 
-    for row in ws.iter_rows():
-        if (row[0].internal_value == 'OBSFILE'):
-            continue
+    # the rows of a transect folder are together in the spreadsheet, so each folder is written as soon
+    # as its rows end, while the cameras of the next few are sampled
+    pool = metadata_pool(args.workers[0] if args.workers else None)
+    spill = RunSpill()
+    try:
+        runs = folder_runs(read_spreadsheet(args.spreadsheet[0], use_cache=not args.no_cache))
+        for image_folder, entries, sample in sampled_runs(pool, root_import_path, runs, spill):
+            write_folder(pool, root_import_path, image_folder, entries, sample)
 
-        obs_file_name = row[0].internal_value
-        image_original_file_path = row[1].internal_value
-        latitude = row[2].internal_value
-        longitude = row[3].internal_value
-        depth = row[4].internal_value
-        image_datetime = row[5].internal_value
-        record_datetime = row[6].internal_value
-        tag_string = row[7].internal_value
-        seagrass_cover = row[8].internal_value
-        camera_name = 'null'
-        camera_angle = 'Downward'
-        temperature = fill_value
-        salinity = fill_value
-        pitch_angle = fill_value
-        roll_angle = fill_value
-        yaw_angle = fill_value
-        altitude = fill_value
-
-        split_path = image_original_file_path.split("\\")
+        # folders whose rows are split up get the rest of them added
+        for image_folder, entries in spill.folders():
+            sample = start_camera_sample(pool, root_import_path, image_folder, [image_name for image_name, row in entries])
+            write_folder(pool, root_import_path, image_folder, entries, sample,
+                         read_images_rows(os.path.join(root_import_path, image_folder, images_filename)))
+    finally:
+        spill.close()
 
-        image_folder = split_path[-2]
-        image_name = split_path[-1]
-
-        # get the camera from the EXIF data, if we can
-        camera_name = get_camera_makemodel(os.path.join(root_import_path,image_folder, image_name))
-
-        # make the descriptopm file if it doesn't exist
-        if not os.path.isfile(os.path.join(root_import_path, image_folder, description_filename)):
-            with open(os.path.join(root_import_path,image_folder, description_filename), "w") as f:
-                version_string = 'version:'+current_format_version+'\n'
-                f.write(version_string)
-                deployment_type_string = 'Type: TI\n'
-                f.write(deployment_type_string)
-                Description_string = 'Description:'+image_folder+' Transects\n'
-                f.write(Description_string)
-
-        # make the images file if it doesn't exist
-        if not os.path.isfile(os.path.join(root_import_path,image_folder, images_filename)):
-            with open(os.path.join(root_import_path,image_folder, images_filename), "w") as f:
-                version_string = 'version:'+current_format_version+'\n'
-                f.write(version_string)
-                headers = 'Time ,Latitude , Longitude  , Depth  , ImageName , CameraName , CameraAngle , Temperature (celcius) , Salinity (psu) , Pitch (radians) , Roll (radians) , Yaw (radians) , Altitude (metres)\n'
-                f.write(headers)
-
-        #append to csv
-        with open(os.path.join(root_import_path,image_folder, images_filename), "a") as f:
-            csv_string = unicode(image_datetime)+','+str(latitude)+','+str(longitude)+','+str(depth)+','+image_name+','+camera_name+','+str(camera_angle)+','+str(temperature)+','+str(salinity)+','+str(pitch_angle)+','+str(roll_angle)+','+str(yaw_angle)+','+str(altitude)+'\n'
-            f.write(csv_string)
+    pool.close()
+    pool.join()
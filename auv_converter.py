@@ -15,14 +15,19 @@ import os.path
 import imghdr
 import argparse
 import glob
-import time
+import hashlib
+import Queue
+from collections import deque
 
-from multiprocessing import Pool, Lock
+from multiprocessing import Pool, Lock, active_children, cpu_count
+from multiprocessing.queues import SimpleQueue
 
 # date handling
 import datetime
 from dateutil.tz import tzutc
 
+import numpy as np
+
 # for netcdf files
 from scipy.io import netcdf
 
@@ -34,66 +39,56 @@ from progressbar import ProgressBar, Percentage, Bar, Timer
 
 from PIL import Image
 
+# reads 16-bit colour GeoTIFFs as they are, PIL can only manage single channel ones
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from catami_common import ImagesFileWriter, image_kind, is_complete_jpeg, link_or_copy, list_directory, metadata_pool, scan_directory
+
 globallock = Lock()
 
 parser = argparse.ArgumentParser(description='Parse AUV Data to produce a valid Catami project.')
 parser.add_argument('--path', nargs=1, help='Path to root AUV data directory')
 parser.add_argument('--deployment', action='store_true', default=False, help='Convert the directory as a deployment, to be attached to an existing campaign')
 parser.add_argument('--outputpath', nargs=1, help='Path to create for the converted data package')
-
-args = parser.parse_args()
-make_deployment = args.deployment
-root_import_path = args.path[0]
-root_output_path = args.outputpath[0]
-
-print 'Looking in: ', root_import_path
-
-if not os.path.isdir(root_import_path):
-    raise Exception('This is not a valid path. Check the path to your AUV data.')
-
-if os.path.isdir(root_output_path):
-    raise Exception('The specified output path already exists.')
+parser.add_argument('--incremental', action='store_true', default=False, help='Carry on converting into an existing output path, only redoing what is missing or out of date')
+parser.add_argument('--workers', nargs=1, type=int, help='Number of image conversion processes (default: sized to the cores and memory available)')
+parser.add_argument('--tonemap', nargs=1, choices=['none', 'percentile', 'gamma'], default=['none'], help='How 16-bit images are brought down to 8 bits: none (leave it to PIL), percentile (stretch between the 0.5 and 99.5 percentiles of a sample of the dive) or gamma (fixed --gain and --gamma)')
+parser.add_argument('--gain', nargs=1, type=float, default=[1.0], help='Tone mapping gain applied to 16-bit values before scaling to 8 bits (default 1.0)')
+parser.add_argument('--gamma', nargs=1, type=float, default=[1.0], help='Tone mapping gamma (default 1.0, linear)')
+parser.add_argument('--passthrough', nargs=1, choices=['auto', 'copy', 'never'], default=['auto'], help='Images that are already JPEGs are put in the output without re-encoding: auto (reflink, hard link or copy, whichever works first), copy (reflink or copy, never a hard link) or never (always re-encode)')
+parser.add_argument('--derivatives', action='store_true', default=False, help='Also write web sized and thumbnail copies of each image, from the same decode, into web/ and thumbnails/')
+parser.add_argument('--interpolate', action='store_true', default=False, help='Linearly interpolate temperature and salinity to the image times instead of using the nearest reading')
 
 images_filename = 'images.csv'
+images_headers = ['Time', 'Latitude', 'Longitude', 'Depth', 'ImageName', 'CameraName', 'CameraAngle', 'Temperature (celcius)',
+                  'Salinity (psu)', 'Pitch (radians)', 'Roll (radians)', 'Yaw (radians)', 'Altitude (metres)']
 description_filename = 'description.txt'
 campaign_filename = 'campaign.txt'
+manifest_filename = '.conversion_manifest.csv'
+# the options images.csv was made with, an --incremental run with others rebuilds it
+index_settings_filename = '.images_settings'
+conversion_errors_filename = 'conversion_errors.csv'
+tonemap_filename = '.tonemap_lut.npz'
+tonemap_sample_size = 16
+# seconds a WatchedPool waits for a result before checking the processes running its tasks are still alive
+pool_poll_interval = 5.0
+# readings spread across a netcdf file whose order is checked before TIME is binary searched
+time_order_samples = 1024
+# derivative sub-directories of a deployment and the longest side of their images
+derivative_sizes = [('web', 1024), ('thumbnails', 256)]
+# extensions of the source images of a dive, preferred in this order when an image has more than one
+source_image_extensions = ['.tif', '.tiff', '.jpg', '.jpeg']
+# JPEG colour modes the server takes as they are, anything else (CMYK...) is re-encoded
+passthrough_modes = ('RGB', 'L')
 
 #version 1.0 format described at https://github.com/catami/catami/wiki/Data-importing
 current_format_version = '1.0'
 fill_value = -999.
 
 
-class LimitTracker:
-    """A class to easily track limits of a value/field.
-
-    The field specifies the option key of the object to look up, or if
-    field is None (the default) use the value itself. All values are
-    converted to floats before comparison.
-
-    minimum and maximum specify starting points.
-    """
-
-    def __init__(self, field=None, minimum=float("inf"),
-                 maximum=float("-inf")):
-        self.maximum = maximum
-        self.minimum = minimum
-        self.field = field
-
-    def check(self, newobject):
-        """Check a new value against the existing limits.
-        """
-        # check if field exists
-        if self.field and self.field in newobject:
-            value = float(newobject[self.field])
-            # then see if it is a new maximum
-            self.maximum = max(self.maximum, value)
-            self.minimum = min(self.minimum, value)
-        elif not self.field:
-            value = float(newobject)
-            self.maximum = max(self.maximum, value)
-            self.minimum = min(self.minimum, value)
-
-
 class NetCDFParser:
     """A class to wrap retrieving values from AUV NetCDF files.
 
@@ -101,37 +96,38 @@ class NetCDFParser:
     date string as it is not absolutely defined given the starting point.
     It searches for times within 10 seconds of the initial guess.
 
-    It implements the iterator interface returning dictionaries with salinity,
-    temperature and time of measurement.
+    The file is memory mapped and nothing is read until it is asked for.
+    window() finds the readings covering a time range, then times() and
+    column() return just those readings, as unix seconds and floats, so only
+    the pages holding them are read from disk. TIME, PSAL and TEMP are always
+    available; other variables (depth, oxygen...) can be requested as well.
+    close() releases the file once the readings needed have been copied out.
     """
     secs_in_day = 24.0 * 3600.0
     imos_seconds_offset = 631152000.0
     imos_days_offset = imos_seconds_offset / secs_in_day
 
-    def __init__(self, file_handle):
-        self.file_handle = file_handle
-
-        # the netcdf file
-        self.reader = netcdf.netcdf_file(self.file_handle, mode='r')
+    def __init__(self, filename, variables=()):
+        self.filename = filename
 
-        if not 'TIME' in self.reader.variables:
-            # error, something is missing
-            print 'WARNING: TIME not in netcdf file variables list.'
-            raise KeyError("Key 'TIME' not in netcdf file variables list.")
+        # the netcdf file, memory mapped so columns are only paged in as they are used
+        self.reader = netcdf.netcdf_file(self.filename, mode='r', mmap=True)
 
-        if not 'PSAL' in self.reader.variables:
-            print 'WARNING: PSAL not in netcdf file variables list.'
-            raise KeyError("Key 'PSAL' not in netcdf file variables list.")
+        self.variables = ['TIME', 'PSAL', 'TEMP'] + [name for name in variables if name not in ('TIME', 'PSAL', 'TEMP')]
 
-        if not 'TEMP' in self.reader.variables:
-            print 'WARNING: TEMP not in netcdf file variables list.'
-            raise KeyError("Key 'TEMP' not in netcdf file variables list.")
+        for name in self.variables:
+            if not name in self.reader.variables:
+                # error, something is missing
+                print 'WARNING:', name, 'not in netcdf file variables list.'
+                raise KeyError("Key '{0}' not in netcdf file variables list.".format(name))
 
-        # the index we are up to...
-        self.index = 0
-        self.items = len(self.reader.variables['TIME'].data)
+        self.items = self.reader.variables['TIME'].shape[0]
         print("Finished opening NetCDF file.")
 
+    def close(self):
+        """Close the file, the arrays returned by times() and column() are copies and stay usable."""
+        self.reader.close()
+
     def imos_to_unix(self, imos_time):
         """Convert IMOS time to UNIX time.
 
@@ -151,31 +147,177 @@ class NetCDFParser:
         """
         return datetime.datetime.fromtimestamp(self.imos_to_unix(imos_time),
                                                tz=tzutc())
-    def isFinished(self):
-        return self.index >= self.items
 
-    def next(self):
-        """Get the next row in the NetCDF File.
+    def unix_to_imos(self, unix_time):
+        """Convert UNIX time to IMOS time."""
+        return unix_time / self.secs_in_day + self.imos_days_offset
+
+    def window(self, start_time, end_time):
+        """Get the readings covering start_time to end_time (unix seconds).
+
+        The window includes the reading either side of the range so the
+        first and last images still have a neighbour on both sides. TIME is
+        binary searched, touching only a handful of pages, once a spread of
+        time_order_samples readings across the file is found in order, and
+        the slice found is checked to be in order too. Otherwise all of TIME
+        is read and the window is a boolean mask of the readings in range
+        (align_measurements puts them in order).
         """
-        i = self.index
-        self.index += 1
+        imos_time = self.reader.variables['TIME'].data
+        start_imos = self.unix_to_imos(start_time)
+        end_imos = self.unix_to_imos(end_time)
+
+        if np.all(np.diff(imos_time[::max(1, self.items // time_order_samples)]) >= 0):
+            start = np.searchsorted(imos_time, start_imos, side='left')
+            end = np.searchsorted(imos_time, end_imos, side='right')
+            window = slice(max(start - 1, 0), min(end + 1, self.items))
+            if np.all(np.diff(imos_time[window]) >= 0):
+                return window
+
+        print 'WARNING: The readings in', self.filename, 'are not in time order, reading all of them'
+        imos_time = np.array(imos_time, dtype=float)
+        window = (imos_time >= start_imos) & (imos_time <= end_imos)
+        before = imos_time < start_imos
+        if before.any():
+            window |= imos_time == imos_time[before].max()
+        after = imos_time > end_imos
+        if after.any():
+            window |= imos_time == imos_time[after].min()
+
+        return window
+
+    def times(self, window=slice(None)):
+        """Measurement times in window as an array of unix seconds."""
+        return self.imos_to_unix(self.column('TIME', window))
+
+    def column(self, name, window=slice(None)):
+        """Values of the variable name in window as a floating point array.
+
+        Fill values are returned as NaN.
+        """
+        if not name in self.variables:
+            raise KeyError("Key '{0}' was not requested from the netcdf file.".format(name))
+
+        variable = self.reader.variables[name]
+        # copy the slice out of the memory map, keeping the file's own float type
+        values = np.array(variable.data[window])
+        if values.dtype.kind != 'f':
+            values = values.astype(float)
+
+        fill_value = getattr(variable, '_FillValue', None)
+        if fill_value is not None:
+            values[values == fill_value] = np.nan
+
+        return values
+
+
+class MergedNetCDF:
+    """Several NetCDF files from one dive (a mission split after a restart) read as one.
+
+    The TIME columns are read up front and merged into time order; a reading
+    time that turns up in more than one file is only taken from the first.
+    window(), times(), column() and close() work as for NetCDFParser, each
+    file still only reading the rows of the window asked for.
+    """
+
+    def __init__(self, filenames, variables=()):
+        self.parsers = [NetCDFParser(filename, variables) for filename in filenames]
+        self.variables = self.parsers[0].variables
+
+        imos_time = np.concatenate([np.array(parser.reader.variables['TIME'].data, dtype=float) for parser in self.parsers])
+        source = np.concatenate([np.repeat(index, parser.items) for index, parser in enumerate(self.parsers)])
+        row = np.concatenate([np.arange(parser.items) for parser in self.parsers])
+
+        # a stable sort, so of several readings at the same time the first file's comes first
+        order = np.argsort(imos_time, kind='mergesort')
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = np.diff(imos_time[order]) != 0
+        order = order[keep]
+
+        self.imos_time = imos_time[order]
+        self.source = source[order]
+        self.row = row[order]
+        self.items = len(order)
+
+        if len(order) < len(imos_time):
+            print 'MESSAGE: Ignored', len(imos_time) - len(order), 'netcdf readings repeated across files'
+
+    def window(self, start_time, end_time):
+        """See NetCDFParser.window."""
+        start = np.searchsorted(self.imos_time, self.parsers[0].unix_to_imos(start_time), side='left')
+        end = np.searchsorted(self.imos_time, self.parsers[0].unix_to_imos(end_time), side='right')
+
+        return slice(max(start - 1, 0), min(end + 1, self.items))
 
-        time = self.reader.variables['TIME'].data[i]
-        sal = self.reader.variables['PSAL'].data[i]
-        temp = self.reader.variables['TEMP'].data[i]
+    def close(self):
+        """See NetCDFParser.close."""
+        for parser in self.parsers:
+            parser.close()
 
-        return {'date_time': self.imos_to_datetime(time),
-                'salinity': sal,
-                'temperature': temp}
+    def times(self, window=slice(None)):
+        """Measurement times in window as an array of unix seconds."""
+        return self.parsers[0].imos_to_unix(self.imos_time[window])
+
+    def column(self, name, window=slice(None)):
+        """Values of the variable name in window as a float array, fill values as NaN."""
+        source = self.source[window]
+        row = self.row[window]
+        values = np.empty(len(row))
+
+        for index, parser in enumerate(self.parsers):
+            mine = source == index
+            if mine.any():
+                rows = row[mine]
+                values[mine] = parser.column(name, slice(rows.min(), rows.max() + 1))[rows - rows.min()]
+
+        return values
+
+
+def open_netcdf(filenames, variables=()):
+    """ a NetCDFParser for a dive's one netcdf file, or a MergedNetCDF for several
+    """
+    if len(filenames) == 1:
+        return NetCDFParser(filenames[0], variables)
+
+    return MergedNetCDF(filenames, variables)
+
+
+def align_measurements(sample_times, image_times, samples, interpolate=False):
+    """Match image times to hydro measurements in bulk.
+
+    sample_times and image_times are arrays of unix seconds. samples is a dict
+    of name -> array of values at each of sample_times. Returns a dict of
+    name -> array of values at each image time, taken from the nearest
+    measurement or, if interpolate is True, linearly interpolated between the
+    measurements either side. Image times outside the measurements get the
+    first or last value.
+    """
+    # searchsorted needs the measurements in time order
+    if np.any(np.diff(sample_times) < 0):
+        order = np.argsort(sample_times, kind='mergesort')
+        sample_times = sample_times[order]
+        samples = dict((name, values[order]) for name, values in samples.items())
+
+    if interpolate:
+        return dict((name, np.interp(image_times, sample_times, values)) for name, values in samples.items())
+
+    later = np.clip(np.searchsorted(sample_times, image_times), 0, len(sample_times) - 1)
+    earlier = np.clip(later - 1, 0, len(sample_times) - 1)
+    # find which is closer
+    use_earlier = (sample_times[later] - image_times) > (image_times - sample_times[earlier])
+    closer = np.where(use_earlier, earlier, later)
+
+    return dict((name, values[closer]) for name, values in samples.items())
 
 
 class TrackParser:
     """A class to parse the csv stereo pose tracks for AUV deployments.
 
-    It can be given a URI that it will retrieve the file from. It returns
-    a dictionary using the header row to determine the keys and the values
-    for each row.
+    The preamble is skipped up to the 'year' header row. read_columns() then
+    loads the track in one pass into columns: a float array for each of the
+    numeric columns and a list of strings for leftimage.
     """
+    numeric_columns = ['latitude', 'longitude', 'depth', 'altitude', 'roll', 'pitch', 'heading']
 
     def __init__(self, file_handle):
         """Open a parser for AUV track files.
@@ -185,6 +327,7 @@ class TrackParser:
         self.file_handle = file_handle
 
         self.reader = csv.reader(self.file_handle)
+        self.header = None
 
         # skip until year is the first entry
         for row in self.reader:
@@ -194,13 +337,143 @@ class TrackParser:
                 # the next line is the first data line
                 # so construction is finished
 
-    def next(self):
-        """Get next row of track file."""
-        # create a dict of the column headers and the values
-        return dict(zip(self.header, self.reader.next()))
+        if self.header is None:
+            raise IOError("Cannot find the header row of the track file.")
 
-    def __iter__(self):
-        return self
+    def read_columns(self):
+        """Read the rest of the track file into a dict of column name -> values."""
+        # ignore short (blank or truncated) lines
+        rows = [row for row in self.reader if len(row) >= len(self.header)]
+        if len(rows) > 0:
+            columns = zip(*rows)
+        else:
+            columns = [()] * len(self.header)
+
+        track = {}
+        for name in self.numeric_columns:
+            track[name] = np.array(columns[self.header.index(name)], dtype=float)
+        track['leftimage'] = list(columns[self.header.index('leftimage')])
+
+        return track
+
+
+def read_tracks(filenames):
+    """ the columns (see TrackParser.read_columns) of one or more track files, one after the other
+    """
+    tracks = []
+    for filename in filenames:
+        with open(filename, "r") as f:
+            tracks.append(TrackParser(f).read_columns())
+
+    track = {}
+    for name in TrackParser.numeric_columns:
+        track[name] = np.concatenate([part[name] for part in tracks])
+    track['leftimage'] = [left_image for part in tracks for left_image in part['leftimage']]
+
+    return track
+
+
+def unique_files(filenames):
+    """ filenames less any that are byte for byte copies of an earlier one
+    """
+    unique = []
+    seen = set()
+    sizes = [os.path.getsize(filename) for filename in filenames]
+
+    for filename, size in zip(filenames, sizes):
+        # only files the same size as another can be copies, so only they are hashed
+        if sizes.count(size) > 1:
+            digest = hashlib.md5()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), ''):
+                    digest.update(block)
+            key = (size, digest.hexdigest())
+        else:
+            key = (size, filename)
+
+        if key in seen:
+            print 'WARNING: Skipping', filename, '- it is a copy of another file.'
+            continue
+        seen.add(key)
+        unique.append(filename)
+
+    return unique
+
+
+def decode_image_times(image_names):
+    """Decode the capture times in AUV image names, in bulk.
+
+    Names look like PR_20090611_225833_662_LC16 (with any extension), the
+    fraction of a second having 1 to 6 digits. The fields are sliced out of
+    the names at fixed offsets, working on all the names at once as a byte
+    array. Returns (times, valid): int64 epoch microseconds and a boolean
+    mask that is False (with a time of 0) for names that don't match.
+    """
+    stems = [os.path.splitext(name)[0] for name in image_names]
+    width = 32
+    count = len(stems)
+
+    lengths = np.array([len(stem) for stem in stems], dtype=np.int64)
+    chars = np.array(stems, dtype='S{0}'.format(width)).view(np.uint8).reshape(count, width)
+    is_digit = (chars >= ord('0')) & (chars <= ord('9'))
+    digits = chars.astype(np.int64) - ord('0')
+
+    def number(start, end):
+        value = np.zeros(count, dtype=np.int64)
+        for i in range(start, end):
+            value = value * 10 + digits[:, i]
+        return value
+
+    # PR_YYYYMMDD_HHMMSS_
+    valid = (chars[:, 0] == ord('P')) & (chars[:, 1] == ord('R')) & (chars[:, 2] == ord('_'))
+    valid &= (chars[:, 11] == ord('_')) & (chars[:, 18] == ord('_'))
+    valid &= is_digit[:, 3:11].all(axis=1) & is_digit[:, 12:18].all(axis=1)
+
+    # the fraction runs from offset 19 up to the first non digit, then _LC16 ends the name
+    fraction_digits = np.cumprod(is_digit[:, 19:25], axis=1)
+    fraction_length = fraction_digits.sum(axis=1)
+    fraction = (digits[:, 19:25] * fraction_digits * 10 ** np.arange(5, -1, -1)).sum(axis=1)
+
+    suffix_columns = np.minimum(19 + fraction_length[:, np.newaxis] + np.arange(5), width - 1)
+    suffix = chars[np.arange(count)[:, np.newaxis], suffix_columns]
+    valid &= (fraction_length > 0) & (lengths == 24 + fraction_length)
+    valid &= (suffix == np.frombuffer(b'_LC16', dtype=np.uint8)).all(axis=1)
+
+    year = number(3, 7)
+    month = number(7, 9)
+    day = number(9, 11)
+    hour = number(12, 14)
+    minute = number(14, 16)
+    second = number(16, 18)
+
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    valid &= (hour < 24) & (minute < 60) & (second < 60)
+
+    # keep the date arithmetic sane for the names that didn't match
+    year[~valid] = 1970
+    month[~valid] = 1
+    day[~valid] = 1
+
+    months = (year - 1970) * 12 + (month - 1)
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + (day - 1)
+    # 30 February and friends roll into the next month
+    valid &= days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64) == months
+
+    times = (((days * 24 + hour) * 60 + minute) * 60 + second) * 1000000 + fraction
+    times[~valid] = 0
+
+    return times, valid
+
+
+def format_image_times(times):
+    """Format int64 epoch microseconds as the strings str() gives for UTC datetimes.
+
+    e.g. 2009-06-11 22:58:33.662000+00:00, the fraction being left off
+    whole seconds.
+    """
+    text = np.datetime_as_string(times.astype('datetime64[us]'))
+
+    return [t[:10] + ' ' + t[11:19] + ('' if t.endswith('.000000') else t[19:]) + '+00:00' for t in text]
 
 
 class AUVImporter(object):
@@ -223,35 +496,32 @@ class AUVImporter(object):
 
     @classmethod
     def dependency_get(cls, deployment_path):
-        # find the hydro netcdf file
+        # find the hydro netcdf files, a mission split after a restart has more than one
         netcdf_pattern = os.path.join(deployment_path, 'hydro_netcdf/IMOS_AUV_ST_*Z_SIRIUS_FV00.nc')
 
-        matches = glob.glob(netcdf_pattern)
+        matches = sorted(glob.glob(netcdf_pattern))
 
         if len(matches) < 1:
             raise IOError("Cannot find netcdf file.")
-        elif len(matches) > 1:
-            raise IOError("Too many potential netcdf files.")
 
-        print("NetCDF File: {0}".format(matches[0]))
+        for match in matches:
+            print("NetCDF File: {0}".format(match))
 
-        netcdf_filename = matches[0]
+        netcdf_filenames = unique_files(matches)
 
-        # find the track file
+        # find the track files
         track_pattern = os.path.join(deployment_path, 'track_files/*_latlong.csv')
 
-        matches = glob.glob(track_pattern)
+        matches = sorted(glob.glob(track_pattern))
 
         if len(matches) < 1:
             print 'WARNING: Cannot file track file.'
             raise IOError("Cannot find track file.")
-        elif len(matches) > 1:
-            print 'WARNING: Too many potential track files.'
-            raise IOError("Too many potential track files.")
 
-        print("Track File: {0}".format(matches[0]))
+        for match in matches:
+            print("Track File: {0}".format(match))
 
-        track_filename = matches[0]
+        track_filenames = unique_files(matches)
 
         # get the image subfolder name
         image_folder_pattern = os.path.join(deployment_path, 'i*_gtif')
@@ -268,8 +538,9 @@ class AUVImporter(object):
         image_foldername = matches[0]
 
         files = {}
-        files['netcdf'] = netcdf_filename
-        files['track'] = track_filename
+        # lists of one or more files
+        files['netcdf'] = netcdf_filenames
+        files['track'] = track_filenames
         files['image'] = image_foldername
 
         return files
@@ -282,7 +553,7 @@ class AUVImporter(object):
         auvdeployment_import(auvdeployment, files)
 
 
-def auvdeployment_import(files):
+def auvdeployment_import(files, interpolate=False):
     """Import an AUV deployment from disk.
 
     This uses the track file and hydro netcdf files (as per RELEASE_DATA).
@@ -296,14 +567,16 @@ def auvdeployment_import(files):
     Information obtained within the function includes start and end time stamps,
     start and end positions, min and max depths and mission aim. Additionally the
     region column, and other AUV specific fields are filled.
+
+    Temperature and salinity come from the nearest hydro measurement, or are
+    interpolated between measurements if interpolate is True.
     """
 
     print("MESSAGE: Starting auvdeployment import")
     auvdeployment = {}
 
-    netcdf = NetCDFParser(open(files['netcdf'], "rb"))
-    track_parser = TrackParser(open(files['track'], "r"))
     image_subfolder = files['image']
+    sources = source_images(image_subfolder)
 
     # now start going through and creating the data
     auvdeployment['mission_aim'] = "Generic Description."
@@ -321,90 +594,113 @@ def auvdeployment_import(files):
     leftcamera['name'] = "Left Colour"
     leftcamera['angle'] = "Downward"
 
-    first_image = None
-    last_image = None
-
-    lat_lim = LimitTracker('latitude')
-    lon_lim = LimitTracker('longitude')
-
-    print("First readings from netcdf file.")
-    earlier_seabird = netcdf.next()
-    later_seabird = netcdf.next()
-
     # now we get to the images... (and related data)
     print("Begin parsing images.")
 
-    first_image = None
-    last_image = None
+    track = read_tracks(files['track'])
+
+    # image capture times come from the image names
+    image_times, valid = decode_image_times(track['leftimage'])
+    if not valid.all():
+        for left_image in np.array(track['leftimage'], dtype=object)[~valid]:
+            print 'WARNING: Cannot get a time from image name', left_image, '- skipping it.'
+        for name in TrackParser.numeric_columns:
+            track[name] = track[name][valid]
+        track['leftimage'] = [left_image for left_image, is_valid in zip(track['leftimage'], valid) if is_valid]
+        image_times = image_times[valid]
+
+    # one row per image in time order, track files of a split mission can overlap
+    order = np.argsort(image_times, kind='mergesort')
+    names, first = np.unique(np.array(track['leftimage'], dtype=object)[order], return_index=True)
+    keep = order[np.sort(first)]
+    if len(keep) < len(image_times) or np.any(np.diff(keep) < 0):
+        if len(keep) < len(image_times):
+            print 'MESSAGE: Ignored', len(image_times) - len(keep), 'images repeated in the track files'
+        for name in TrackParser.numeric_columns:
+            track[name] = track[name][keep]
+        track['leftimage'] = [track['leftimage'][index] for index in keep]
+        image_times = image_times[keep]
+    image_date_times = format_image_times(image_times)
+
+    count = len(track['leftimage'])
+
+    if count == 0:
+        print 'WARNING: No images found in the track file.'
+        return None, None
+
     image_list = []
     # campaign_name = auvdeployment.campaign.short_name
     # deployment_name = auvdeployment.short_name
-    count = 0
-    for row in track_parser:
-        count += 1
+    # plain floats; repr() gives back the track file's digits when writing them out
+    columns = zip(track['leftimage'], image_date_times,
+                  track['latitude'].tolist(), track['longitude'].tolist(), track['depth'].tolist(),
+                  track['roll'].tolist(), track['pitch'].tolist(), track['heading'].tolist(), track['altitude'].tolist())
+    for left_image, date_time, latitude, longitude, depth, roll, pitch, heading, altitude in columns:
         current_image = {}
-        image_name = os.path.splitext(row['leftimage'])[0] + ".tif"
-
-        image_datetime = datetime.datetime.strptime(os.path.splitext(image_name)[0], "PR_%Y%m%d_%H%M%S_%f_LC16")
-        image_datetime = image_datetime.replace(tzinfo=tzutc())
-        current_image['date_time'] = str(image_datetime)
-        current_image['position'] = "POINT ({0} {1})".format(row['longitude'], row['latitude'])
-        current_image['latitude'] = row['latitude']
-        current_image['longitude'] = row['longitude']
-
-        depth = float(row['depth'])
-        current_image['depth'] = row['depth']
-        # quickly calculate limit info
+        image_name = source_image_name(sources, left_image)
 
-        if depth > float(auvdeployment['max_depth']):
-            auvdeployment['max_depth'] = str(depth)
-
-        if depth < float(auvdeployment['min_depth']):
-            auvdeployment['min_depth'] = str(depth)
-
-        lat_lim.check(row)
-        lon_lim.check(row)
+        current_image['date_time'] = date_time
+        current_image['position'] = "POINT ({0!r} {1!r})".format(longitude, latitude)
+        current_image['latitude'] = latitude
+        current_image['longitude'] = longitude
+        current_image['depth'] = depth
 
         # calculate image locations and create thumbnail
         current_image['image_path'] = os.path.join(image_subfolder, image_name)
 
-        # get the extra measurements from the seabird data
-        while image_datetime > later_seabird['date_time'] and not netcdf.isFinished():
-            later_seabird, earlier_seabird = earlier_seabird, netcdf.next()
-
-        # find which is closer - could use interpolation instead
-        if (later_seabird['date_time'] - image_datetime) > (image_datetime - earlier_seabird['date_time']):
-            closer_seabird = earlier_seabird
-        else:
-            closer_seabird = later_seabird
-
-        current_image['temperature'] = closer_seabird['temperature']
-        current_image['salinity'] = closer_seabird['salinity']
-        current_image['roll'] = row['roll']
-        current_image['pitch'] = row['pitch']
-        current_image['yaw'] = row['heading']
-        current_image['altitude'] = row['altitude']
+        current_image['roll'] = roll
+        current_image['pitch'] = pitch
+        current_image['yaw'] = heading
+        current_image['altitude'] = altitude
         current_image['camera'] = leftcamera['name']
         current_image['camera_angle'] = leftcamera['angle']
 
         image_list.append(current_image)
 
-        # we need first and last to get start/end points and times
-        last_image = current_image
-        if first_image is None:
-            first_image = current_image
+    # we need first and last to get start/end points and times
+    first_image = image_list[0]
+    last_image = image_list[-1]
+
+    # get the extra measurements from the seabird data, reading only the part of the
+    # netcdf file the images span
+    print("Matching images to netcdf readings.")
+    image_times = image_times / 1e6
+    netcdf = open_netcdf(files['netcdf'])
+    try:
+        window = netcdf.window(image_times.min(), image_times.max())
+        seabird = align_measurements(netcdf.times(window),
+                                     image_times,
+                                     {'temperature': netcdf.column('TEMP', window), 'salinity': netcdf.column('PSAL', window)},
+                                     interpolate=interpolate)
+    finally:
+        netcdf.close()
+
+    for index, current_image in enumerate(image_list):
+        current_image['temperature'] = seabird['temperature'][index]
+        current_image['salinity'] = seabird['salinity'][index]
+        # readings that were fill values in the netcdf file
+        if np.isnan(current_image['temperature']):
+            current_image['temperature'] = fill_value
+        if np.isnan(current_image['salinity']):
+            current_image['salinity'] = fill_value
 
     # now save the actual min/max depth as well as start/end times and
     # start position and end position
 
     print 'done with ', count, 'images'
+    auvdeployment['min_depth'] = str(track['depth'].min())
+    auvdeployment['max_depth'] = str(track['depth'].max())
+
     auvdeployment['start_time_stamp'] = first_image['date_time']
     auvdeployment['end_time_stamp'] = last_image['date_time']
 
     auvdeployment['start_position'] = first_image['position']
     auvdeployment['end_position'] = last_image['position']
 
-    auvdeployment['transect_shape'] = 'POLYGON(({0} {2}, {0} {3}, {1} {3}, {1} {2}, {0} {2} ))'.format(lon_lim.minimum, lon_lim.maximum, lat_lim.minimum, lat_lim.maximum)
+    auvdeployment['transect_shape'] = 'POLYGON(({0!r} {2!r}, {0!r} {3!r}, {1!r} {3!r}, {1!r} {2!r}, {0!r} {2!r} ))'.format(float(track['longitude'].min()),
+                                                                                                                       float(track['longitude'].max()),
+                                                                                                                       float(track['latitude'].min()),
+                                                                                                                       float(track['latitude'].max()))
 
     return auvdeployment, image_list
 
@@ -418,135 +714,812 @@ def is_image(image_path):
         return False
 
 
+def read_raw_image(image_path):
+    """ the pixel values of an image as a numpy array, 16-bit images keep all 16 bits
+    """
+    if tifffile is not None and os.path.splitext(image_path)[1].lower() in ('.tif', '.tiff'):
+        return tifffile.imread(image_path)
+
+    return np.asarray(Image.open(image_path))
+
+
+def make_tonemap(image_paths, mode, gain=1.0, gamma=1.0):
+    """ a 65536 entry lookup table from 16-bit values to 8-bit ones
+
+        percentile stretches the 0.5 to 99.5 percentile range of a sample of image_paths to the full
+        8 bits, gamma scales values by gain. Either way the result is then raised to 1/gamma.
+        Sample images that can't be read are skipped, an IOError is raised if none of them can be.
+    """
+    values = np.arange(65536, dtype=np.float64)
+
+    if mode == 'percentile':
+        # every 8th pixel of images spread evenly through the dive
+        step = max(1, len(image_paths) / tonemap_sample_size)
+        samples = []
+        for image_path in image_paths[::step][:tonemap_sample_size]:
+            try:
+                samples.append(read_raw_image(image_path)[::8, ::8].ravel())
+            except Exception, e:
+                print 'WARNING: Left', image_path, 'out of the tone mapping sample -', '{0}: {1}'.format(type(e).__name__, e)
+        if len(samples) == 0:
+            raise IOError('None of the tone mapping sample images could be read' +
+                          (', install tifffile to read 16-bit colour GeoTIFFs' if tifffile is None else ''))
+        low, high = np.percentile(np.concatenate(samples), [0.5, 99.5])
+        if high <= low:
+            high = low + 1
+        scaled = (values - low) / (high - low)
+    else:
+        scaled = values * gain / 65535.
+
+    return np.round(np.clip(scaled, 0., 1.) ** (1. / gamma) * 255.).astype(np.uint8)
+
+
+def prepare_tonemap(deployment_output_path, image_paths, tonemap):
+    """ the path of the deployment's tone mapping table, made from image_paths if there isn't one for
+        these settings already. returns (path, True if the table was made afresh)
+    """
+    lut_path = os.path.join(deployment_output_path, tonemap_filename)
+    settings = repr(tonemap)
+
+    if os.path.isfile(lut_path):
+        cached = np.load(lut_path)
+        if str(cached['settings']) == settings:
+            return lut_path, False
+
+    print 'MESSAGE: Making', tonemap[0], 'tone mapping table'
+    lut = make_tonemap(image_paths, *tonemap)
+    # written under a temporary name so a worker never loads half a table
+    with open(lut_path + '.tmp', 'wb') as f:
+        np.savez(f, lut=lut, settings=np.array(settings))
+    os.rename(lut_path + '.tmp', lut_path)
+
+    return lut_path, True
+
+
+# tone mapping tables loaded in this process, by path
+tonemap_luts = {}
+
+
+def load_image(input_image, lut_path=None):
+    """ a PIL image of input_image, tone mapped to 8 bits through the table at lut_path if there is one
+    """
+    if lut_path is None:
+        return Image.open(input_image)
+
+    if lut_path not in tonemap_luts:
+        tonemap_luts[lut_path] = np.load(lut_path)['lut']
+    pixels = read_raw_image(input_image)
+    if pixels.dtype == np.uint16:
+        pixels = tonemap_luts[lut_path][pixels]
+
+    return Image.fromarray(pixels)
+
+
+def derivative_paths(output_image):
+    """ where the derivatives of a converted image go, in the order of derivative_sizes
+    """
+    deployment_output_path, image_name = os.path.split(output_image)
+    return [os.path.join(deployment_output_path, directory, image_name) for directory, size in derivative_sizes]
+
+
+def save_derivatives(image, output_image, quality_val):
+    """ writes the smaller copies of an already decoded (or opened JPEG) image, each made from the one before
+    """
+    # a JPEG can be decoded straight to a fraction of its size
+    image.draft(image.mode, (2 * derivative_sizes[0][1], 2 * derivative_sizes[0][1]))
+
+    for (directory, size), derivative_path in zip(derivative_sizes, derivative_paths(output_image)):
+        # thumbnail() resizes in place, the copy keeps the image it is made from intact
+        image = image.copy()
+        image.thumbnail((size, size), Image.ANTIALIAS)
+        image.save(derivative_path, quality=quality_val)
+
+
+def passthrough_image(input_image):
+    """ the opened image if input_image is a whole JPEG (by its magic bytes and end marker) in a colour
+        mode the server takes, so it can be used as it is, otherwise None
+    """
+    if image_kind(input_image) != 'jpeg' or not is_complete_jpeg(input_image):
+        return None
+
+    image = Image.open(input_image)
+    if image.mode not in passthrough_modes:
+        return None
+
+    return image
+
+
 def convert_file(local_tuple):
     """ convert image to a Catami safe format
+        an optional third entry in local_tuple is a dict of options, 'tonemap' the path of a tone mapping
+        table for 16-bit images, 'derivatives' True to write the web and thumbnail copies as well and
+        'passthrough' (auto, copy or never) for how JPEG sources are put in place without re-encoding
+        returns (input image, output image, error message or None)
     """
     input_image = local_tuple[0]
     output_image = local_tuple[1]
+    options = local_tuple[2] if len(local_tuple) > 2 else {}
+    passthrough = options.get('passthrough', 'never')
     quality_val = 90
     try:
-        Image.open(input_image).save(output_image, quality=quality_val)
+        image = passthrough_image(input_image) if passthrough != 'never' else None
+        if image is not None:
+            # already something the server takes, re-encoding would only lose quality
+            link_or_copy(input_image, output_image, hard_link=(passthrough == 'auto'))
+        else:
+            image = load_image(input_image, options.get('tonemap'))
+            image.save(output_image, quality=quality_val)
+
+        if options.get('derivatives'):
+            save_derivatives(image, output_image, quality_val)
     except Exception, e:
-        raise e
+        return input_image, output_image, '{0}: {1}'.format(type(e).__name__, e)
 
+    return input_image, output_image, None
 
-def convert_deployment(deployment_import_path, deployment_output_path):
-    """ creates a new directory and populates it with a Catami format structure based on the deployment
-        found in 'deployment_import_path'.
-        Images are converted to JPG
+
+def convert_files(image_name_list):
+    """ convert_file over a chunk of images, so a chunk is one task for a pool
     """
+    return [convert_file(local_tuple) for local_tuple in image_name_list]
 
-    success = True
+
+# set in each WatchedPool process, tasks report the process they run in on it
+task_starts = None
+
+
+def init_watched_process(starts):
+    """ WatchedPool initializer, keeps the queue tasks report their start on
+    """
+    global task_starts
+    task_starts = starts
+
+
+def run_watched_task(task_id, function, args):
+    """ runs function(*args) as WatchedPool task task_id, first telling the parent which process has it
+        returns (task id, True, result), or (task id, False, error message) if it raised
+    """
+    task_starts.put((task_id, os.getpid()))
+    try:
+        return task_id, True, function(*args)
+    except Exception, e:
+        return task_id, False, '{0}: {1}'.format(type(e).__name__, e)
+
+
+class WatchedPool:
+    """ A pool of processes that notices tasks lost with their process.
+
+        A process killed mid-task (out of memory, a crash in an image library) never reports back, and a
+        plain Pool waits for it forever. Each task here reports the process it runs in as it starts, and
+        when no result has come for pool_poll_interval seconds the tasks whose process is gone are given
+        up on. Processes that die idle or are replaced by the pool don't affect anything, and a result that
+        still turns up for a task given up on is ignored.
+    """
+
+    def __init__(self, processes):
+        self.starts = SimpleQueue()
+        self.pool = Pool(processes=processes, initializer=init_watched_process, initargs=(self.starts,))
+        self.done = Queue.Queue()
+        # task id -> (tag, function making the result of a failed task from the error message)
+        self.tasks = {}
+        # task id -> pid of the process running it
+        self.owners = {}
+        self.next_task_id = 0
+        self.lost = 0
+
+    def submit(self, tag, function, args, failed):
+        """ runs function(*args) in the pool. next_result hands back (tag, result), or (tag, failed(error))
+            if the task raised or its process died
+        """
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        self.tasks[task_id] = (tag, failed)
+        self.pool.apply_async(run_watched_task, (task_id, function, args), callback=self.done.put)
+
+    def next_result(self):
+        """ waits for the next task to finish or be lost, returns its (tag, result)
+        """
+        while True:
+            self.read_starts()
+            try:
+                task_id, succeeded, result = self.done.get(timeout=pool_poll_interval)
+            except Queue.Empty:
+                self.check_owners()
+                continue
+
+            if task_id not in self.tasks:
+                # given up on already
+                continue
+            tag, failed = self.tasks.pop(task_id)
+            self.owners.pop(task_id, None)
+            return tag, result if succeeded else failed(result)
+
+    def read_starts(self):
+        # drained every time round, a full pipe would block the workers
+        while not self.starts.empty():
+            task_id, pid = self.starts.get()
+            if task_id in self.tasks:
+                self.owners[task_id] = pid
+
+    def check_owners(self):
+        self.read_starts()
+        alive = set(process.pid for process in active_children())
+        for task_id, pid in self.owners.items():
+            if pid not in alive:
+                del self.owners[task_id]
+                self.lost += 1
+                self.done.put((task_id, False, 'the process running it died'))
+
+    def close(self):
+        """ waits for the processes to exit, the pool must have no tasks left
+        """
+        if self.lost > 0:
+            print 'WARNING:', self.lost, 'tasks were lost with their process'
+            # the pool still counts the lost tasks as running and would never finish joining
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+
+def free_memory_bytes():
+    """ the free physical memory, or None where the system doesn't say (SC_AVPHYS_PAGES is missing on
+        macOS, and os.sysconf on Windows)
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, AttributeError, OSError):
+        return None
+
+
+def conversion_worker_count(image_name_list):
+    """ how many images can be converted at once; one per core, but no more than fit in half the free memory
+        given the size of a decoded image (judged from the header of the first one)
+    """
+    workers = cpu_count()
+
+    free_memory = free_memory_bytes()
+    if free_memory is None:
+        return workers
+
+    try:
+        image = Image.open(image_name_list[0][0])
+        # decoded source, converted copy and encoder buffers
+        bytes_per_image = image.size[0] * image.size[1] * len(image.getbands()) * (2 if image.mode.startswith('I;16') or image.mode in ('I', 'F') else 1) * 3
+    except (IndexError, IOError):
+        return workers
+
+    return max(1, min(workers, free_memory / 2 / max(bytes_per_image, 1)))
+
+
+def run_conversions(image_name_list, manifest, workers=None):
+    """ converts images in a pool sized to the machine, recording each success in the manifest
+        returns a list of (input image, output image, error message) for the conversions that failed,
+        including those lost with a process that died (see WatchedPool)
+    """
+    if len(image_name_list) == 0:
+        return []
+
+    if workers is None:
+        workers = conversion_worker_count(image_name_list)
+    # a few chunks per worker keeps the workers busy without an IPC round trip per image
+    chunksize = max(1, min(16, len(image_name_list) / (workers * 4)))
+
+    print 'MESSAGE: Converting', len(image_name_list), 'images with', workers, 'processes'
+    pbar = ProgressBar(widgets=[Percentage(), Bar(), Timer()], maxval=len(image_name_list)).start()
+    pool = WatchedPool(workers)
+    for start in range(0, len(image_name_list), chunksize):
+        chunk = image_name_list[start:start + chunksize]
+        pool.submit(None, convert_files, (chunk,),
+                    lambda error, chunk=chunk: [(local_tuple[0], local_tuple[1], error) for local_tuple in chunk])
+
+    count = 0
+    failures = []
+    while count < len(image_name_list):
+        tag, chunk_results = pool.next_result()
+        for input_image, output_image, error in chunk_results:
+            if error is None:
+                manifest.record(input_image, output_image)
+            else:
+                failures.append((input_image, output_image, error))
+        count = count + len(chunk_results)
+        pbar.update(count)
+    pbar.finish()
+    pool.close()
+
+    return failures
+
+
+def write_conversion_errors(deployment_output_path, failures):
+    """ lists failed conversions in the deployment's conversion error report, or removes the report if there are none
+    """
+    report_path = os.path.join(deployment_output_path, conversion_errors_filename)
+
+    if len(failures) == 0:
+        if os.path.isfile(report_path):
+            os.remove(report_path)
+        return
+
+    with open(report_path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Source', 'Output', 'Error'])
+        writer.writerows(failures)
+
+    print 'WARNING:', len(failures), 'images failed to convert, see', report_path
+
+
+class ConversionManifest:
+    """A record of the image conversions done in an output deployment.
+
+    Each line holds a converted image's name and the size and modification
+    time of the source it came from. Lines are flushed as each conversion
+    finishes, so after a crash a re-run knows which images are already done.
+    """
+
+    def __init__(self, deployment_output_path):
+        self.path = os.path.join(deployment_output_path, manifest_filename)
+        self.entries = {}
+
+        needs_newline = False
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                for row in csv.reader(f):
+                    # a line cut short by a crash is simply ignored
+                    try:
+                        self.entries[row[0]] = (int(row[1]), float(row[2]))
+                    except (IndexError, ValueError):
+                        pass
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    needs_newline = f.read(1) != '\n'
+
+        self.file = open(self.path, 'ab')
+        if needs_newline:
+            self.file.write('\n')
+        self.writer = csv.writer(self.file)
+
+    def is_current(self, input_image, output_image, scanned=None):
+        """True if output_image was made from input_image as it is now.
+
+        scanned is a dict of path -> ScanEntry covering both images' folders
+        (see scan_directory); with it neither image is stat'ed again and a
+        path that isn't in it doesn't exist.
+        """
+        if scanned is not None:
+            input_info = scanned.get(input_image)
+            output_info = scanned.get(output_image)
+            if input_info is None or output_info is None:
+                return False
+            input_size, input_mtime, output_mtime = input_info.size, input_info.mtime, output_info.mtime
+        else:
+            if not os.path.isfile(output_image):
+                return False
+            info = os.stat(input_image)
+            input_size, input_mtime, output_mtime = info.st_size, info.st_mtime, os.path.getmtime(output_image)
+
+        if output_mtime < input_mtime:
+            return False
+
+        entry = self.entries.get(os.path.basename(output_image))
+        if entry is not None:
+            return entry == (input_size, input_mtime)
+
+        # converted before there was a manifest, check the file looks whole
+        return is_complete_jpeg(output_image)
+
+    def record(self, input_image, output_image):
+        input_info = os.stat(input_image)
+        self.entries[os.path.basename(output_image)] = (input_info.st_size, input_info.st_mtime)
+        self.writer.writerow([os.path.basename(output_image), input_info.st_size, repr(input_info.st_mtime)])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def is_newer(path, other_paths):
+    """ True if path exists and was modified after all of other_paths
+    """
+    if not os.path.isfile(path):
+        return False
+
+    return all(os.path.getmtime(path) >= os.path.getmtime(other_path) for other_path in other_paths)
+
+
+def index_settings(interpolate):
+    """ the settings recorded beside images.csv, everything that changes its rows other than the input files
+    """
+    return repr({'interpolate': bool(interpolate)})
+
+
+def write_index_settings(deployment_output_path, interpolate):
+    """ records the settings images.csv was just made with
+    """
+    settings_path = os.path.join(deployment_output_path, index_settings_filename)
+    with open(settings_path + '.tmp', 'w') as f:
+        f.write(index_settings(interpolate))
+    os.rename(settings_path + '.tmp', settings_path)
+
+
+def is_index_current(deployment_output_path, files, interpolate):
+    """ True if the deployment's images.csv is newer than the track and netcdf files and was made with
+        the same settings
+    """
+    if not is_newer(os.path.join(deployment_output_path, images_filename), files['netcdf'] + files['track']):
+        return False
+
+    try:
+        with open(os.path.join(deployment_output_path, index_settings_filename)) as f:
+            return f.read() == index_settings(interpolate)
+    except IOError:
+        return False
+
+
+def read_image_names(images_path):
+    """ the ImageName column of an existing images.csv
+    """
+    with open(images_path, 'rb') as csvfile:
+        images_reader = csv.reader(csvfile)
+        #skip the header rows (2)
+        images_reader.next()
+        images_reader.next()
+
+        return [row[4] for row in images_reader if len(row) > 4]
+
+
+def deployment_short_name(deployment_import_path):
+    """ the deployment short name is the name of the dive directory
+    """
+    if deployment_import_path[-1] == '/':
+        return deployment_import_path.split('/')[-2]
+    else:
+        return deployment_import_path.split('/')[-1]
+
+
+def source_images(image_folder):
+    """ the source image file name of each image in a dive's image folder, by name without extension
+        an image kept in more than one format is taken from the first of source_image_extensions
+    """
+    sources = {}
+    for name in list_directory(image_folder)[1]:
+        stem, extension = os.path.splitext(name)
+        if extension.lower() not in source_image_extensions:
+            continue
+        if stem not in sources or source_image_extensions.index(extension.lower()) < source_image_extensions.index(os.path.splitext(sources[stem])[1].lower()):
+            sources[stem] = name
+
+    return sources
+
+
+def source_image_name(sources, image_name):
+    """ the source file (from source_images) of an image named in the track file or images.csv,
+        a GeoTIFF if there is none
+    """
+    stem = os.path.splitext(image_name)[0]
+    return sources.get(stem, stem + '.tif')
+
+
+def output_image_name(image):
+    """ the name of the converted JPEG of an image from auvdeployment_import
+    """
+    return os.path.splitext(image['image_path'].split('/')[-1])[0]+'.jpg'
+
+
+def image_rows(image_list):
+    """ the images.csv rows (see images_headers) for the images from auvdeployment_import
+    """
+    rows = []
+    for image in image_list:
+        # in CATAMI 'depth' is depth of seafloor.  AUV 'depth' is depth of platform, so seafloor depth is AUV depth+ AUV altitude
+        depth_actual = float(image['depth']) + float(image['altitude'])
+
+        rows.append([image['date_time'], image['latitude'], image['longitude'], depth_actual, output_image_name(image),
+                     image['camera'], image['camera_angle'], image['temperature'], image['salinity'],
+                     image['pitch'], image['roll'], image['yaw'], image['altitude']])
+
+    return rows
+
+
+def write_description(deployment_output_path, short_name):
+    """ make the description file if it doesn't exist
+    """
+    if not os.path.isfile(os.path.join(deployment_output_path, description_filename)):
+        with open(os.path.join(deployment_output_path, description_filename), "w") as f:
+            version_string = 'version:'+current_format_version+'\n'
+            f.write(version_string)
+            deployment_type_string = 'Type: AUV\n'
+            f.write(deployment_type_string)
+            Description_string = 'Description:'+short_name+' Imported AUV\n'
+            f.write(Description_string)
+            Operater_string = 'Operator: \n'
+            f.write(Operater_string)
+            Keyword_string = 'Keywords: \n'
+            f.write(Keyword_string)
+
+    print 'Made', description_filename, 'in', short_name
+
+
+def write_images_file(deployment_output_path, image_list):
+    """ writes images.csv for the images from auvdeployment_import
+    """
+    images_path = os.path.join(deployment_output_path, images_filename)
+
+    count = 0
+
+    print 'Making images index...'
+    pbar = ProgressBar(widgets=[Percentage(), Bar(), Timer()], maxval=len(image_list)).start()
+
+    with ImagesFileWriter(images_path, current_format_version, images_headers) as writer:
+        for row in image_rows(image_list):
+            count = count + 1
+            pbar.update(count)
+            writer.write(row)
+    pbar.finish()
+    print 'Made', images_filename, 'in', deployment_output_path
+    print 'Added ', count, 'entries in', deployment_output_path, ":", images_filename
+
+
+def prepare_deployment(deployment_import_path, deployment_output_path, interpolate=False, incremental=False, tonemap=None, derivatives=False, passthrough='auto'):
+    """ creates a new directory and populates it with the Catami description and images index for the
+        deployment found in 'deployment_import_path'.
+        returns the list of (source image, output image) conversions still to be done, or None if the
+        deployment couldn't be imported
+
+        With incremental an existing output directory is reused. images.csv is only rebuilt if the
+        track or netcdf files are newer than it or it was made with a different interpolate, and only images that aren't already converted (as
+        recorded in the conversion manifest) are returned.
+
+        tonemap is None to leave 16-bit conversion to PIL, or (mode, gain, gamma) for make_tonemap. The
+        table is made once per deployment and kept in the output directory; if the settings change every
+        image is converted again.
+
+        derivatives adds the web and thumbnail copies (see derivative_sizes), an image missing either
+        is converted again by an incremental run.
+
+        passthrough is how source images that are already JPEGs are put in place, see convert_file.
+    """
 
     print 'import path is', deployment_import_path
     print 'output path is', deployment_output_path
 
     files = AUVImporter.dependency_get(deployment_import_path)
-    auvdeployment, image_list = auvdeployment_import(files)
-
-    if auvdeployment is None or image_list is None:
-        success = False
+    images_path = os.path.join(deployment_output_path, images_filename)
 
-    if success:
+    if incremental and is_index_current(deployment_output_path, files, interpolate):
+        # the index is up to date, just pick up the image list from it
+        print 'MESSAGE:', images_filename, 'is up to date in', deployment_output_path
+        sources = source_images(files['image'])
+        image_name_list = []
+        for image_name in read_image_names(images_path):
+            image_name_list.append((os.path.join(files['image'], source_image_name(sources, image_name)), os.path.join(deployment_output_path, image_name)))
 
-        try:
-            os.makedirs(deployment_output_path)
-        except OSError as exception:
-                raise exception
+    else:
+        auvdeployment, image_list = auvdeployment_import(files, interpolate=interpolate)
 
-        print deployment_import_path.split('/')[-2]
-        print deployment_import_path.split('/')[-1]
+        if auvdeployment is None or image_list is None:
+            return None
 
-        if deployment_import_path[-1] == '/':
-            auvdeployment['short_name'] = deployment_import_path.split('/')[-2]
-        else:
-            auvdeployment['short_name'] = deployment_import_path.split('/')[-1]
-
-        if not os.path.isfile(os.path.join(deployment_output_path, images_filename)):
-            with open(os.path.join(deployment_output_path, images_filename), "w") as f:
-                version_string = 'version:'+current_format_version+'\n'
-                f.write(version_string)
-                headers = 'Time ,Latitude , Longitude  , Depth  , ImageName , CameraName , CameraAngle , Temperature (celcius) , Salinity (psu) , Pitch (radians) , Roll (radians) , Yaw (radians) , Altitude (metres)\n'
-                f.write(headers)
-        print 'Made', images_filename, 'in', deployment_output_path
-
-        # make the description file if it doesn't exist
-        if not os.path.isfile(os.path.join(deployment_output_path, description_filename)):
-            with open(os.path.join(deployment_output_path, description_filename), "w") as f:
-                version_string = 'version:'+current_format_version+'\n'
-                f.write(version_string)
-                deployment_type_string = 'Type: AUV\n'
-                f.write(deployment_type_string)
-                Description_string = 'Description:'+auvdeployment['short_name']+' Imported AUV\n'
-                f.write(Description_string)
-                Operater_string = 'Operator: \n'
-                f.write(Operater_string)
-                Keyword_string = 'Keywords: \n'
-                f.write(Keyword_string)
-
-        print 'Made', description_filename, 'in', auvdeployment['short_name']
-
-        count = 0
-
-        print 'Making images index...'
-        pbar = ProgressBar(widgets=[Percentage(), Bar(), Timer()], maxval=len(image_list)).start()
+        if not (incremental and os.path.isdir(deployment_output_path)):
+            try:
+                os.makedirs(deployment_output_path)
+            except OSError as exception:
+                    raise exception
 
-        for image in image_list:
-                count = count + 1
-                pbar.update(count)
-                image_name = os.path.splitext(image['image_path'].split('/')[-1])[0]+'.jpg'
-                #append to csv
-                with open(os.path.join(deployment_output_path, images_filename), "a") as f:
-                    # in CATAMI 'depth' is depth of seafloor.  AUV 'depth' is depth of platform, so seafloor depth is AUV depth+ AUV altitude
-                    depth_actual = float(image['depth']) + float(image['altitude'])
-
-                    csv_string = image['date_time']+','+str(image['latitude'])+','+str(image['longitude'])+','+str(depth_actual)+','+image_name+','+image['camera']+','+image['camera_angle']+','+str(image['temperature'])+','+str(image['salinity'])+','+str(image['pitch'])+','+str(image['roll'])+','+str(image['yaw'])+','+str(image['altitude'])+'\n'
-                    f.write(csv_string)
-        pbar.finish()
+        auvdeployment['short_name'] = deployment_short_name(deployment_import_path)
+        write_description(deployment_output_path, auvdeployment['short_name'])
+        write_images_file(deployment_output_path, image_list)
+        write_index_settings(deployment_output_path, interpolate)
 
         image_name_list = []
         for image in image_list:
-            image_name_list.append((image['image_path'], os.path.join(deployment_output_path, os.path.splitext(image['image_path'].split('/')[-1])[0]+'.jpg')))
-        # for image in image_list:
-        #     count = count + 1
-        #     pbar.update(count)
-        #     image_name = image['image_path']
-        #     new_image_name = os.path.join(deployment_output_path, os.path.splitext(image['image_path'].split('/')[-1])[0]+'.jpg')
-        #     try:
-        #         Image.open(image_name).save(new_image_name)
-        #     except IOError:
-        #         print "cannot convert", image_name
-
-        print 'Making image conversions for Catami...'
-        pbar = ProgressBar(widgets=[Percentage(), Bar(), Timer()], maxval=len(image_list)).start()
-        count = 0
-        pool = Pool(processes=10)
-        rs = pool.imap_unordered(convert_file, image_name_list)
+            image_name_list.append((image['image_path'], os.path.join(deployment_output_path, output_image_name(image))))
+
+    options = {'passthrough': passthrough}
+    if tonemap is not None and len(image_name_list) > 0:
+        options['tonemap'], remade = prepare_tonemap(deployment_output_path, [local_tuple[0] for local_tuple in image_name_list], tonemap)
+        if remade:
+            incremental = False
+    if derivatives:
+        options['derivatives'] = True
+        for directory, size in derivative_sizes:
+            if not os.path.isdir(os.path.join(deployment_output_path, directory)):
+                os.makedirs(os.path.join(deployment_output_path, directory))
+    image_name_list = [(input_image, output_image, options) for input_image, output_image in image_name_list]
+
+    if incremental:
+        # the source and output folders are stat'ed in one threaded pass rather than image by image
+        pool = metadata_pool()
+        scanned = {}
+        for folder in set([files['image'], deployment_output_path]):
+            for entry in scan_directory(pool, folder, classify=False):
+                scanned[os.path.join(folder, entry.name)] = entry
         pool.close()
 
-        count = 0
-        num_tasks = len(image_name_list)
-        while (True):
-            pbar.update(rs._index)
-            if (rs._index == num_tasks):
-                break
-            time.sleep(0.5)
-        pbar.finish()
+        manifest = ConversionManifest(deployment_output_path)
+        total = len(image_name_list)
+        image_name_list = [local_tuple for local_tuple in image_name_list
+                           if not manifest.is_current(local_tuple[0], local_tuple[1], scanned)
+                           or (derivatives and not all(os.path.isfile(derivative_path) for derivative_path in derivative_paths(local_tuple[1])))]
+        manifest.close()
+        print 'MESSAGE:', total - len(image_name_list), 'of', total, 'images are already converted'
 
-    print 'Added ', count, 'entries in', deployment_output_path, ":", images_filename
+    return image_name_list
+
+
+def convert_deployment(deployment_import_path, deployment_output_path, interpolate=False, incremental=False, workers=None, tonemap=None, derivatives=False, passthrough='auto'):
+    """ creates a new directory and populates it with a Catami format structure based on the deployment
+        found in 'deployment_import_path'.
+        Images are converted to JPG
+
+        See prepare_deployment for incremental, tonemap, derivatives and passthrough. workers sets the number of conversion processes, by
+        default they are sized to the machine.
+    """
+
+    success = True
+
+    image_name_list = prepare_deployment(deployment_import_path, deployment_output_path, interpolate=interpolate, incremental=incremental, tonemap=tonemap, derivatives=derivatives, passthrough=passthrough)
+    if image_name_list is None:
+        return False
+
+    manifest = ConversionManifest(deployment_output_path)
+
+    print 'Making image conversions for Catami...'
+    failures = run_conversions(image_name_list, manifest, workers)
+    manifest.close()
+
+    write_conversion_errors(deployment_output_path, failures)
+    if len(failures) > 0:
+        success = False
+
+    print 'Converted ', len(image_name_list) - len(failures), 'images in', deployment_output_path
 
     return success
 
 
+def prepare_job(deployment_import_path, deployment_output_path, interpolate, incremental, tonemap, derivatives, passthrough):
+    """ prepare_deployment as a pool task; errors are returned rather than raised so the campaign carries on
+    """
+    try:
+        return deployment_import_path, deployment_output_path, prepare_deployment(deployment_import_path, deployment_output_path, interpolate=interpolate, incremental=incremental, tonemap=tonemap, derivatives=derivatives, passthrough=passthrough), None
+    except Exception, e:
+        return deployment_import_path, deployment_output_path, None, '{0}: {1}'.format(type(e).__name__, e)
+
+
+def convert_campaign(deployments, interpolate=False, incremental=False, workers=None, tonemap=None, derivatives=False, passthrough='auto'):
+    """ converts a list of (import path, output path) deployments in one pool of processes, so the
+        netcdf and track parsing of one deployment runs while the images of others are converted.
+
+        A few deployments are prepared at a time and image conversions are handed to the pool in chunks,
+        with only a couple of chunks per process queued, so a deployment's metadata job never waits behind
+        another deployment's whole image list.
+
+        Tasks lost with their process (see WatchedPool) fail their deployment or images instead of being
+        waited for forever.
+        returns a dict of import path to success
+    """
+    if len(deployments) == 0:
+        return {}
+
+    if workers is None:
+        sample_images = []
+        for deployment_import_path, deployment_output_path in deployments:
+            image_folders = glob.glob(os.path.join(deployment_import_path, 'i*_gtif'))[:1]
+            sample_images = [os.path.join(image_folder, name) for image_folder in image_folders for name in sorted(source_images(image_folder).values())[:1]]
+            if len(sample_images) > 0:
+                break
+        workers = conversion_worker_count([(sample_image,) for sample_image in sample_images])
+
+    chunksize = 8
+    max_chunks_queued = 2 * workers
+    max_preparing = max(1, workers / 4)
+
+    print 'MESSAGE: Converting', len(deployments), 'deployments with', workers, 'processes'
+
+    pool = WatchedPool(workers)
+
+    waiting = deque(deployments)
+    chunks = deque()
+    state = {}
+    results = {}
+    preparing = [0]
+    chunks_queued = [0]
+
+    def start_jobs():
+        # don't prepare further ahead than the next deployment to convert
+        while waiting and preparing[0] < max_preparing and len(state) - preparing[0] < 2:
+            deployment_import_path, deployment_output_path = waiting.popleft()
+            state[deployment_import_path] = None
+            preparing[0] += 1
+            pool.submit(('prepared', deployment_import_path), prepare_job,
+                        (deployment_import_path, deployment_output_path, interpolate, incremental, tonemap, derivatives, passthrough),
+                        lambda error, paths=(deployment_import_path, deployment_output_path): paths + (None, error))
+
+        while chunks and chunks_queued[0] < max_chunks_queued:
+            deployment_import_path, chunk = chunks.popleft()
+            chunks_queued[0] += 1
+            pool.submit(('converted', deployment_import_path), convert_files, (chunk,),
+                        lambda error, chunk=chunk: [(local_tuple[0], local_tuple[1], error) for local_tuple in chunk])
+
+    def finish(deployment_import_path):
+        deployment = state.pop(deployment_import_path)
+        deployment['manifest'].close()
+        write_conversion_errors(deployment['output_path'], deployment['failures'])
+        print 'Converted ', deployment['count'] - len(deployment['failures']), 'images in', deployment['output_path']
+        results[deployment_import_path] = len(deployment['failures']) == 0
+
+    start_jobs()
+    while state:
+        (event, deployment_import_path), result = pool.next_result()
+
+        if event == 'prepared':
+            preparing[0] -= 1
+            deployment_import_path, deployment_output_path, image_name_list, error = result
+
+            if image_name_list is None:
+                if error is not None:
+                    print 'FAILED: Could not prepare', deployment_import_path, '-', error
+                del state[deployment_import_path]
+                results[deployment_import_path] = False
+            else:
+                print 'MESSAGE: Converting', len(image_name_list), 'images in', deployment_output_path
+                state[deployment_import_path] = {'output_path': deployment_output_path,
+                                                 'manifest': ConversionManifest(deployment_output_path),
+                                                 'count': len(image_name_list),
+                                                 'remaining': len(image_name_list),
+                                                 'failures': []}
+                for start in range(0, len(image_name_list), chunksize):
+                    chunks.append((deployment_import_path, image_name_list[start:start + chunksize]))
+                if len(image_name_list) == 0:
+                    finish(deployment_import_path)
+
+        else:
+            chunks_queued[0] -= 1
+            chunk_results = result
+            deployment = state[deployment_import_path]
+            for input_image, output_image, error in chunk_results:
+                if error is None:
+                    deployment['manifest'].record(input_image, output_image)
+                else:
+                    deployment['failures'].append((input_image, output_image, error))
+            deployment['remaining'] -= len(chunk_results)
+            if deployment['remaining'] == 0:
+                finish(deployment_import_path)
+
+        start_jobs()
+
+    pool.close()
+
+    return results
+
+
 def main():
     """Builds Catami format package for Kayak AIMS data
     """
+    # parsed here rather than on import so the uploader can use the import code
+    args = parser.parse_args()
+    make_deployment = args.deployment
+    root_import_path = args.path[0]
+    root_output_path = args.outputpath[0]
+
+    print 'Looking in: ', root_import_path
+
+    if not os.path.isdir(root_import_path):
+        raise Exception('This is not a valid path. Check the path to your AUV data.')
+
+    if os.path.isdir(root_output_path) and not args.incremental:
+        raise Exception('The specified output path already exists. Use --incremental to carry on converting into it.')
+
+    workers = args.workers[0] if args.workers else None
+    tonemap = None if args.tonemap[0] == 'none' else (args.tonemap[0], args.gain[0], args.gamma[0])
+    if tonemap is not None and tifffile is None:
+        print 'WARNING: tifffile is not installed, PIL cannot read 16-bit colour GeoTIFFs to tone map them (pip install tifffile)'
 
     if make_deployment:
-        convert_deployment(root_import_path, root_output_path)
+        convert_deployment(root_import_path, root_output_path, interpolate=args.interpolate, incremental=args.incremental, workers=workers, tonemap=tonemap, derivatives=args.derivatives, passthrough=args.passthrough[0])
     else:
         #look for dirs in the root dir. Ignore pesky hidden dirs added by various naughty things
-        directories = [o for o in os.listdir(root_import_path) if os.path.isdir(os.path.join(root_import_path, o)) and not o.startswith('.')]
+        directories = list_directory(root_import_path)[0]
 
         if len(directories) == 0:
             raise Exception('I didn\'t find any directories to import. Check that the specified path contains kayak image directories.')
@@ -573,8 +1546,12 @@ def main():
                 f.write(string)
         print 'Made', campaign_filename, 'in', root_import_path
 
-        for directory in directories:
-            convert_deployment(os.path.join(root_import_path, directory), os.path.join(root_output_path, directory))
+        deployments = [(os.path.join(root_import_path, directory), os.path.join(root_output_path, directory)) for directory in directories]
+        results = convert_campaign(deployments, interpolate=args.interpolate, incremental=args.incremental, workers=workers, tonemap=tonemap, derivatives=args.derivatives, passthrough=args.passthrough[0])
+
+        failed = [deployment_import_path for deployment_import_path, _ in deployments if not results.get(deployment_import_path)]
+        if len(failed) > 0:
+            print 'WARNING:', len(failed), 'of', len(deployments), 'deployments did not convert cleanly:', ', '.join(failed)
 
     print '...All done'
 
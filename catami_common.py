@@ -0,0 +1,515 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Helpers shared by the Catami conversion tools
+Catami Data Spec V1.0
+https://github.com/catami/catami/wiki/Data-importing
+
+Nothing in here parses command line arguments, so it is safe to import from
+any of the converters.
+"""
+import os
+import os.path
+import csv
+import json
+import shutil
+import struct
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# for reflinks, not available on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# directory listing that knows files from directories without a stat of each (Python 3.5, or the scandir package)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# the FICLONE ioctl, a copy on write clone of a whole file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# leading bytes of the image formats we know about
+image_signatures = [('\xff\xd8\xff', 'jpeg'),
+                    ('\x89PNG\r\n\x1a\n', 'png'),
+                    ('II*\x00', 'tiff'),
+                    ('MM\x00*', 'tiff')]
+
+
+# bytes per value of the EXIF (TIFF) field types
+exif_type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+exif_type_formats = {3: 'H', 4: 'I', 9: 'i', 5: 'I', 10: 'i'}
+
+# threads reading image metadata at once, see metadata_pool
+default_metadata_workers = 8
+
+# read_image_metadata results kept in each image directory, see harvest_metadata
+metadata_cache_filename = '.image_metadata_cache.json'
+
+# bytes read from the start of each file by scan_file, enough for kind_of
+scan_header_size = 8
+
+# a file found by scan_directory, kind is as image_kind gives it
+ScanEntry = namedtuple('ScanEntry', ['name', 'size', 'mtime', 'kind'])
+
+# the EXIF tags read by read_image_metadata
+EXIF_MAKE = 0x010f
+EXIF_MODEL = 0x0110
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+EXIF_DATETIME_ORIGINAL = 0x9003
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+
+
+def kind_of(head):
+    """The image format that the bytes head start with, see image_kind."""
+    for signature, kind in image_signatures:
+        if head.startswith(signature):
+            return kind
+
+    return None
+
+
+def is_complete_jpeg(path):
+    """A cheap validity check, True for a JPEG that starts and ends with the right markers."""
+    if os.path.getsize(path) < 4:
+        return False
+
+    with open(path, 'rb') as f:
+        start = f.read(2)
+        f.seek(-2, os.SEEK_END)
+        end = f.read(2)
+
+    return start == '\xff\xd8' and end == '\xff\xd9'
+
+
+def image_kind(path):
+    """The format of an image file from its first few bytes, 'jpeg', 'png' or 'tiff', or None."""
+    try:
+        with open(path, 'rb') as f:
+            return kind_of(f.read(8))
+    except IOError:
+        return None
+
+
+def read_ifd(tiff, offset, byte_order):
+    """The entries of the TIFF directory at offset, as a dict of tag -> value.
+
+    ASCII values are strings, rationals lists of (numerator, denominator)
+    and single numbers plain ints. Entries pointing outside tiff are left out.
+    """
+    entries = {}
+    count = struct.unpack(byte_order + 'H', tiff[offset:offset + 2])[0]
+
+    for index in range(count):
+        entry = tiff[offset + 2 + 12 * index:offset + 14 + 12 * index]
+        if len(entry) < 12:
+            break
+        tag, value_type, value_count = struct.unpack(byte_order + 'HHI', entry[:8])
+        size = exif_type_sizes.get(value_type)
+        if size is None:
+            continue
+
+        if size * value_count <= 4:
+            data = entry[8:8 + size * value_count]
+        else:
+            value_offset = struct.unpack(byte_order + 'I', entry[8:])[0]
+            data = tiff[value_offset:value_offset + size * value_count]
+        if len(data) < size * value_count:
+            continue
+
+        if value_type == 2:
+            entries[tag] = data.split('\x00')[0].strip()
+        elif value_type in (5, 10):
+            numbers = struct.unpack(byte_order + exif_type_formats[value_type] * (2 * value_count), data)
+            entries[tag] = zip(numbers[0::2], numbers[1::2])
+        elif value_type in exif_type_formats:
+            numbers = struct.unpack(byte_order + exif_type_formats[value_type] * value_count, data)
+            entries[tag] = numbers[0] if value_count == 1 else list(numbers)
+        else:
+            entries[tag] = data
+
+    return entries
+
+
+def exif_degrees(value, reference, positive_reference):
+    """Signed decimal degrees from an EXIF GPS (degrees, minutes, seconds) value, or None."""
+    if value is None or reference is None or len(value) < 3:
+        return None
+
+    try:
+        degrees = sum(float(numerator) / float(denominator) / scale
+                      for (numerator, denominator), scale in zip(value, (1.0, 60.0, 3600.0)))
+    except ZeroDivisionError:
+        return None
+
+    if reference != positive_reference:
+        degrees *= -1
+
+    return degrees
+
+
+def no_metadata():
+    """The metadata of a file that has none, see read_image_metadata."""
+    return dict(kind=None, exif=False, datetime=None, latitude=None, longitude=None, make=None, model=None)
+
+
+def read_image_metadata(path):
+    """Reads the format and EXIF fields of an image file in one pass.
+
+    Only the start of the file is read: the magic bytes, then for a JPEG the
+    segment headers up to the APP1 (EXIF) segment, which is parsed directly.
+    Returns a dict of kind ('jpeg', 'png', 'tiff' or None), exif (True if
+    the file has EXIF data), datetime (the DateTimeOriginal string), latitude
+    and longitude (signed decimal degrees), make and model. Anything the file
+    doesn't have is None. Damaged EXIF data gives what could be read of it.
+    """
+    metadata = no_metadata()
+
+    with open(path, 'rb') as f:
+        metadata['kind'] = kind_of(f.read(8))
+        if metadata['kind'] != 'jpeg':
+            return metadata
+
+        f.seek(2)
+        while True:
+            header = f.read(4)
+            if len(header) < 4 or header[0] != '\xff':
+                break
+            length = struct.unpack('>H', header[2:])[0]
+
+            if header[1] == '\xe1':
+                segment = f.read(length - 2)
+                if segment.startswith('Exif\x00\x00'):
+                    parse_exif(segment[6:], metadata)
+                    break
+            elif header[1] in ('\xda', '\xd9'):
+                # start of the image data, there are no more metadata segments
+                break
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+
+    return metadata
+
+
+def metadata_pool(workers=None):
+    """A pool of threads for harvest_metadata.
+
+    Reading image headers waits on storage rather than the CPU, so threads
+    are enough. How many pay off depends on the storage: a few for a local
+    disk, more for network storage. The default is default_metadata_workers.
+    """
+    return ThreadPool(processes=workers or default_metadata_workers)
+
+
+def read_cached_metadata(task):
+    """read_image_metadata for harvest_metadata. task is (path, cache entry or None); the
+    entry is returned as it is if the file's size and modification time still match it.
+    None if the file has gone, as scan_file.
+    """
+    path, cached = task
+    try:
+        info = os.stat(path)
+        if cached is not None and cached['size'] == info.st_size and cached['mtime'] == info.st_mtime:
+            return cached
+
+        return dict(size=info.st_size, mtime=info.st_mtime, metadata=read_image_metadata(path))
+    except (IOError, OSError):
+        return None
+
+
+def load_metadata_cache(directory):
+    """The metadata cache entries of a directory, by file name."""
+    try:
+        with open(os.path.join(directory, metadata_cache_filename), 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_metadata_cache(directory, entries):
+    """Writes a directory's metadata cache, in one go so a crash can't leave half of it."""
+    cache_path = os.path.join(directory, metadata_cache_filename)
+    try:
+        with open(cache_path + '.tmp', 'wb') as f:
+            json.dump(entries, f)
+        os.rename(cache_path + '.tmp', cache_path)
+    except (IOError, OSError, ValueError), e:
+        # read only media or odd EXIF bytes, the next run just reads the images again
+        print 'WARNING: Could not save the metadata cache in', directory, '-', e
+
+
+# the metadata cache entries of each directory known to this process, shared by every Harvest
+loaded_caches = {}
+# the cache entries harvested from each directory by this process, the only ones saved back
+harvested_caches = {}
+# what each directory's cache file holds
+saved_caches = {}
+
+
+class Harvest(object):
+    """The metadata of a list of images being read by harvest_metadata."""
+
+    def __init__(self, pool, paths, use_cache=True):
+        self.directories = set()
+        tasks = []
+        for path in paths:
+            directory, name = os.path.split(path)
+            if use_cache:
+                if directory not in loaded_caches:
+                    loaded_caches[directory] = load_metadata_cache(directory)
+                    saved_caches[directory] = dict(loaded_caches[directory])
+                self.directories.add(directory)
+            tasks.append((path, loaded_caches[directory].get(name) if use_cache else None))
+
+        self.paths = paths
+        self.result = pool.map_async(read_cached_metadata, tasks, chunksize=16)
+
+    def get(self):
+        """The metadata dicts in the same order as the paths, waiting for them if need be."""
+        entries = self.result.get()
+
+        if self.directories:
+            for path, entry in zip(self.paths, entries):
+                directory, name = os.path.split(path)
+                if entry is not None:
+                    harvested_caches.setdefault(directory, {})[name] = entry
+                    loaded_caches[directory][name] = entry
+            # the cache is rewritten with just what this run has harvested, so files that have been
+            # deleted or renamed drop out of it
+            for directory in self.directories:
+                harvested = harvested_caches.get(directory, {})
+                saved = saved_caches[directory]
+                if set(harvested) != set(saved) or any(saved[name] is not entry for name, entry in harvested.items()):
+                    save_metadata_cache(directory, harvested)
+                    saved_caches[directory] = dict(harvested)
+
+        return [no_metadata() if entry is None else entry['metadata'] for entry in entries]
+
+
+def harvest_metadata(pool, paths, use_cache=True):
+    """Starts read_image_metadata on every one of paths in pool.
+
+    Returns a Harvest; its get() is the list of metadata dicts in the same
+    order as paths. Start several directories before getting any of them
+    and they are read together.
+
+    With use_cache the results are kept in a hidden file in each image
+    directory, and a later harvest only reads the images whose size or
+    modification time has changed since. The file only keeps the images
+    harvested by the latest run. A file that is gone by the time
+    it is read gets no_metadata().
+    """
+    return Harvest(pool, paths, use_cache)
+
+
+def list_directory(path):
+    """The (subdirectory names, file names) of a directory, both in name order.
+
+    Hidden entries (.DS_Store, caches, ...) are left out. With scandir the
+    directory entries say what they are, so nothing is stat'ed to tell files
+    from directories.
+    """
+    directories = []
+    files = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                directories.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            if name.startswith('.'):
+                continue
+            if os.path.isdir(os.path.join(path, name)):
+                directories.append(name)
+            elif os.path.isfile(os.path.join(path, name)):
+                files.append(name)
+
+    return sorted(directories), sorted(files)
+
+
+def scan_file(path, classify=True):
+    """The ScanEntry of a file, from one stat and (with classify) one small read of its header.
+
+    None if the file has gone, or can't be stat'ed, since it was listed.
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+
+    kind = None
+    if classify:
+        try:
+            with open(path, 'rb') as f:
+                kind = kind_of(f.read(scan_header_size))
+        except IOError:
+            pass
+
+    return ScanEntry(os.path.basename(path), info.st_size, info.st_mtime, kind)
+
+
+def scan_directory(pool, path, classify=True):
+    """The ScanEntry of every file in a directory, in name order.
+
+    The files are stat'ed and classified in pool (see metadata_pool). Without
+    classify the headers aren't read and every kind is None.
+    """
+    directories, files = list_directory(path)
+    entries = pool.map(lambda file_path: scan_file(file_path, classify), [os.path.join(path, name) for name in files], chunksize=16)
+
+    return [entry for entry in entries if entry is not None]
+
+
+def scan_tree(pool, path):
+    """The files of each subdirectory of path, as an OrderedDict of
+    directory name -> list of ScanEntry, both in name order.
+
+    The subdirectories are listed in pool at the same time, then all of
+    their files are stat'ed and classified together.
+    """
+    directories = list_directory(path)[0]
+    listings = pool.map(list_directory, [os.path.join(path, directory) for directory in directories])
+
+    paths = [os.path.join(path, directory, name) for directory, (subdirectories, files) in zip(directories, listings) for name in files]
+    entries = iter(pool.map(scan_file, paths, chunksize=16))
+
+    return OrderedDict((directory, [entry for entry in [entries.next() for name in files] if entry is not None])
+                       for directory, (subdirectories, files) in zip(directories, listings))
+
+
+def parse_exif(tiff, metadata):
+    """Fills in metadata (see read_image_metadata) from the TIFF structure of an EXIF segment."""
+    try:
+        byte_order = '<' if tiff[:2] == 'II' else '>'
+        ifd0 = read_ifd(tiff, struct.unpack(byte_order + 'I', tiff[4:8])[0], byte_order)
+        metadata['exif'] = True
+        metadata['make'] = ifd0.get(EXIF_MAKE)
+        metadata['model'] = ifd0.get(EXIF_MODEL)
+
+        if EXIF_IFD_POINTER in ifd0:
+            exif_ifd = read_ifd(tiff, ifd0[EXIF_IFD_POINTER], byte_order)
+            metadata['datetime'] = exif_ifd.get(EXIF_DATETIME_ORIGINAL)
+
+        if GPS_IFD_POINTER in ifd0:
+            gps_ifd = read_ifd(tiff, ifd0[GPS_IFD_POINTER], byte_order)
+            latitude = exif_degrees(gps_ifd.get(GPS_LATITUDE), gps_ifd.get(GPS_LATITUDE_REF), 'N')
+            longitude = exif_degrees(gps_ifd.get(GPS_LONGITUDE), gps_ifd.get(GPS_LONGITUDE_REF), 'E')
+            # a position needs both halves
+            if latitude is not None and longitude is not None:
+                metadata['latitude'] = latitude
+                metadata['longitude'] = longitude
+    except (struct.error, IndexError, TypeError, ValueError):
+        pass
+
+
+def link_or_copy(source, destination, hard_link=True):
+    """Puts source at destination as cheaply as the filesystem allows.
+
+    Tries a reflink (a copy on write clone) first, then a hard link if
+    hard_link is True, then a plain copy. A hard link shares the file with
+    the source, so only use one where neither will be edited in place.
+    Whatever is at destination already is replaced. Returns the method used,
+    'reflink', 'link' or 'copy'.
+    """
+    temporary_path = destination + '.tmp'
+    if os.path.lexists(temporary_path):
+        os.remove(temporary_path)
+
+    method = None
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as source_file, open(temporary_path, 'wb') as destination_file:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            method = 'reflink'
+        except (IOError, OSError):
+            os.remove(temporary_path)
+
+    if method is None and hard_link:
+        try:
+            os.link(source, temporary_path)
+            method = 'link'
+        except OSError:
+            pass
+
+    if method is None:
+        shutil.copy2(source, temporary_path)
+        method = 'copy'
+
+    os.rename(temporary_path, destination)
+
+    return method
+
+
+class ImagesFileWriter(object):
+    """Writes a Catami images.csv in one go.
+
+    Rows are buffered and written through the csv module batch_size at a
+    time into a temporary file next to the real one. close() renames it into
+    place, so a crash part way through leaves any earlier images.csv alone
+    rather than half an index. Keep one writer open per output deployment.
+
+    None values are written as 'None', which is what the uploader looks for
+    in place of missing fields. Unicode values are written as UTF-8.
+    """
+
+    def __init__(self, path, version, headers, batch_size=1000):
+        self.path = path
+        self.temporary_path = path + '.tmp'
+        self.batch_size = batch_size
+        self.buffer = []
+        self.count = 0
+
+        self.file = open(self.temporary_path, 'wb')
+        self.writer = csv.writer(self.file)
+
+        self.file.write('version:' + version + '\n')
+        self.writer.writerow(headers)
+
+    def write(self, row):
+        """Add a row (a list of values) to the file."""
+        self.buffer.append(['None' if value is None else value.encode('utf-8') if isinstance(value, unicode) else value
+                            for value in row])
+        self.count += 1
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        """Finish the file and move it into place."""
+        self.flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.temporary_path, self.path)
+
+    def abort(self):
+        """Throw the file away, leaving any existing images.csv as it was."""
+        self.file.close()
+        os.remove(self.temporary_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -35,15 +35,23 @@ import httplib
 #format support
 import csv
 import json
+import hashlib
+import io
+import tempfile
 import numpy as np
 
 from multiprocessing import Pool
+from collections import deque
+import Queue
+import threading
 import time
 
 # progress bars
 from progressbar import ProgressBar, Percentage, Bar, Timer
 
 from PIL import Image
+
+from catami_common import is_complete_jpeg, list_directory, scan_directory, scan_file, scan_tree, metadata_pool
 # from PIL.ExifTags import TAGS, GPSTAGS
 
 # Command line options setup
@@ -58,16 +66,34 @@ parser.add_argument('--apikey', nargs=1, help='API Key for your Catami account,
 group = parser.add_mutually_exclusive_group()
 group.add_argument('--deployment', nargs=1, help='Path to root Catami data directory for campaign, ie: /data/somthing/some_campaign. You must also specify --campaign-api')
 group.add_argument('--campaign', nargs=1, help='Path to root Catami data directory for campaign, ie: /data/somthing/some_campaign')
+group.add_argument('--auv', nargs=1, help='Path to a raw AUV dive, ie: /data/auv/r20090611_063540_kingston_scuba, to convert and upload in one pass. You must also specify --campaign_api')
 
 parser.add_argument('--campaign_api', nargs=1, help='URL for Campaign specified at --server')
 
+parser.add_argument('--timeout', nargs=1, type=float, help='Seconds to wait for the server to answer an image upload before giving up (default 120).')
+parser.add_argument('--min_rate', nargs=1, type=float, help='Slowest acceptable image upload rate in images/second before the upload is considered stalled (default 0.05).')
+parser.add_argument('--hedge', action='store_true', default=False, help='Send a duplicate request for the last few slow images of a deployment.')
+parser.add_argument('--prefetch_mb', nargs=1, type=float, help='Megabytes of image data to read ahead of the uploads (default 128).')
+parser.add_argument('--read_order', choices=['csv', 'disk'], default='csv', help='Read images in images.csv order (default) or in on-disk (inode) order.')
+parser.add_argument('--redrive', action='store_true', default=False, help='Only re-upload the images listed in each deployment\'s failed_images.csv.')
+parser.add_argument('--delta', action='store_true', default=False, help='Only send the images.csv rows added, changed or removed since the last upload.')
+parser.add_argument('--force_delete', action='store_true', default=False, help='With --delta, remove images from the server even when most of the uploaded images are missing from images.csv.')
+parser.add_argument('--local_copy', nargs=1, help='With --auv, also write the converted deployment (description.txt, images.csv and JPEGs) to this path.')
+parser.add_argument('--no_cache', action='store_true', default=False, help='Look campaigns and deployments up on the server instead of using the local URI cache.')
+
 args = parser.parse_args()
 
+if args.auv and (args.redrive or args.delta):
+    parser.exit(1, 'You cannot use --redrive or --delta with --auv, use them with --deployment on the --local_copy of the dive')
+
 if not args.validate:
-    if not args.deployment and not args.campaign:
-        parser.exit(1, 'You must specify --deployment or --campaign')
+    if not args.deployment and not args.campaign and not args.auv:
+        parser.exit(1, 'You must specify --deployment, --campaign or --auv')
+
+    if args.auv and not args.campaign_api:
+        parser.exit(1, 'You must specify --campaign_api with --auv')
 
-    if not args.deployment and not args.campaign_api:
+    if args.deployment and not args.campaign_api and not args.redrive and not args.delta:
         parser.exit(1, 'You must specify --campaign_api with --deployment')
 
     if args.campaign and args.campaign_api:
@@ -89,9 +115,69 @@ images_filename = 'images.csv'
 description_filename = 'description.txt'
 campaign_filename = 'campaign.txt'
 
+#images that failed to upload are recorded here, per deployment, for --redrive
+dead_letter_filename = 'failed_images.csv'
+dead_letter_headers = ['ImageName', 'Deployment', 'StatusCode', 'Attempts', 'Response']
+
+#record of the last upload of each deployment, for --delta
+snapshot_filename = '.images_uploaded.csv'
+snapshot_headers = ['ImageName', 'RowHash', 'ImageURI', 'CameraURI', 'MeasurementURI']
+
+#images.csv fields, in file order
+image_fields = ['time', 'latitude', 'longitude', 'depth', 'image_name', 'camera_name', 'camera_angle',
+                'temperature', 'salinity', 'pitch', 'roll', 'yaw', 'altitude', 'depth_uncertainty']
+
+#campaign and deployment resource URIs already known for each server, shared by every upload run
+uri_cache_filename = os.path.join(os.path.expanduser('~'), '.catami_uri_cache.json')
+
 #used to check for duplicate POST attempting
 duplicate_error_message = 'duplicate key value violates unique constraint'
 
+#(connect, read) timeouts in seconds for every request to the server.  The bulk metadata PATCHes
+# carry a whole deployment in one request, so they get a longer read timeout
+connect_timeout = 10.0
+read_timeout = 120.0
+if args.timeout:
+    read_timeout = args.timeout[0]
+request_timeout = (connect_timeout, read_timeout)
+bulk_request_timeout = (connect_timeout, 10 * read_timeout)
+
+#an image upload that times out or gets a server error is tried this many times before it is dead lettered
+max_upload_attempts = 3
+
+#longest a single image upload can take: every attempt timing out, plus the backoff between attempts
+image_upload_budget = max_upload_attempts * (connect_timeout + read_timeout) + sum([2 ** attempt for attempt in range(1, max_upload_attempts)])
+
+#image upload watchdog.  If fewer than min_upload_rate images/second complete over the last
+# stall_window seconds the upload is considered stalled and is abandoned.  Near the end of a deployment
+# (or for a small one) fewer images are left than that, then half of those still outstanding must complete.
+# The window outlasts one image's retries, so images being retried are not mistaken for a stall
+min_upload_rate = 0.05
+if args.min_rate:
+    min_upload_rate = args.min_rate[0]
+stall_window = max(300.0, image_upload_budget + 60.0)
+
+#hedged requests.  Once only the last hedge_fraction of a deployment's images are outstanding and
+# nothing has completed for hedge_delay seconds, the stragglers are sent again on a fresh pool.
+# Duplicate image POSTs are harmless, the server reports the image as already existing.
+use_hedging = args.hedge
+hedge_fraction = 0.01
+hedge_delay = 30.0
+
+#image files are read sequentially, ahead of the upload workers, into a buffer of at most
+# prefetch_bytes so that many workers don't compete for the head of a slow external disk
+prefetch_bytes = 128 * 1024 * 1024
+if args.prefetch_mb:
+    prefetch_bytes = int(args.prefetch_mb[0] * 1024 * 1024)
+read_order = args.read_order
+
+#number of objects per PATCH when sending --delta changes
+delta_batch_size = 500
+
+#--delta refuses to remove more than this fraction of a deployment's uploaded images without --force_delete,
+# that is more likely the wrong directory or a broken images.csv than a real edit
+max_delete_fraction = 0.5
+
 
 def get_status_code(host, path="/"):
     """ This function retreives the status code of a website by requesting
@@ -100,18 +186,81 @@ def get_status_code(host, path="/"):
         None instead.
     """
     try:
-        conn = httplib.HTTPConnection(server_root, 80)
+        conn = httplib.HTTPConnection(server_root, 80, timeout=connect_timeout)
         conn.request("HEAD", path)
         return conn.getresponse().status
     except StandardError:
         return None
 
 
+def load_uri_cache():
+    """Reads the local URI cache. The cache is a JSON dict of server -> {'campaigns': {key: uri},
+        'deployments': {key: {'uri': uri, 'id': deployment ID}}}, campaign keys being
+        'short_name|date_start' and deployment keys 'campaign URI|short_name'
+    """
+    if os.path.isfile(uri_cache_filename):
+        try:
+            with open(uri_cache_filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            print 'WARNING: Ignoring unreadable URI cache', uri_cache_filename
+
+    return {}
+
+
+def cached_uri(kind, key):
+    """Returns the cached entry of kind ('campaigns' or 'deployments') for key on the current server, or None
+    """
+    if args.no_cache:
+        return None
+
+    return load_uri_cache().get(server_root.rstrip('/'), {}).get(kind, {}).get(key)
+
+
+def save_uri_cache(cache):
+    """Writes the URI cache. The file is replaced atomically, through a temporary file of its own, so
+        other runs and tools never see it half written
+    """
+    descriptor, temporary_filename = tempfile.mkstemp(dir=os.path.dirname(uri_cache_filename),
+                                                      prefix=os.path.basename(uri_cache_filename) + '.')
+    try:
+        with os.fdopen(descriptor, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.rename(temporary_filename, uri_cache_filename)
+    except (IOError, OSError), e:
+        print 'WARNING: Could not save the URI cache', uri_cache_filename, '-', e
+        if os.path.isfile(temporary_filename):
+            os.remove(temporary_filename)
+
+
+def cache_uri(kind, key, entry):
+    """Saves an entry in the URI cache for the current server
+    """
+    cache = load_uri_cache()
+    cache.setdefault(server_root.rstrip('/'), {}).setdefault(kind, {})[key] = entry
+    save_uri_cache(cache)
+
+
+def drop_cached_uri(kind, key):
+    """Removes an entry that is no longer on the server from the URI cache for the current server
+    """
+    cache = load_uri_cache()
+    if cache.get(server_root.rstrip('/'), {}).get(kind, {}).pop(key, None) is not None:
+        save_uri_cache(cache)
+
+
+def uri_exists(uri, params):
+    """False if the server says a (cached) resource URI is gone, anything but a 404 counts as still there
+    """
+    r = requests.get(urlparse.urljoin(server_root, uri), params=params, timeout=request_timeout)
+    return r.status_code != requests.codes.not_found
+
+
 def check_url(server, path):
     """ Does simple check on server+path to verify response
     """
 
-    r = requests.get(urlparse.urljoin(server, path))
+    r = requests.get(urlparse.urljoin(server, path), timeout=request_timeout)
     if r.status_code != requests.codes.ok:
         print 'FAILED: server API problem detected for', path
         return False
@@ -138,7 +287,7 @@ def basic_import_checks(root_import_path, server_root):
         everthing_is_fine = False
         print 'MISSING: Campaign file is missing at', root_import_path
 
-    directories = [o for o in os.listdir(root_import_path) if os.path.isdir(os.path.join(root_import_path, o)) and not o.startswith('.')]
+    directories = list_directory(root_import_path)[0]
 
     if len(directories) == 0:
         everthing_is_fine = False
@@ -168,9 +317,12 @@ def check_deployment_files(deployment_path):
     return everthing_is_fine
 
 
-def check_deployment_images(deployment_path):
+def check_deployment_images(deployment_path, entries=None):
     """Check deployment imagery for valid list and valid imagery
+        entries are the deployment's files from scan_directory, with them the images are checked
+        without touching the disk again
     """
+    files = None if entries is None else dict((entry.name, entry) for entry in entries)
 
     print 'MESSAGE: Checking Deployment', images_filename, '...'
     bad_image_count = 0
@@ -259,9 +411,22 @@ def check_deployment_images(deployment_path):
 
                 if not (image_name is None or str(image_name) == 'None'):
                     #lets check this image
-                    if os.path.isfile(os.path.join(deployment_path, image_name)):
+                    if files is not None and image_name in files:
+                        entry = files[image_name]
+                    elif os.path.isfile(os.path.join(deployment_path, image_name)):
+                        entry = scan_file(os.path.join(deployment_path, image_name))
+                    else:
+                        entry = None
+
+                    if entry is not None:
+                        # a JPEG is checked for its end marker, so a truncated copy is caught without decoding it,
+                        # anything else is left to PIL
                         try:
-                            Image.open(os.path.join(deployment_path, image_name))
+                            if entry.kind == 'jpeg':
+                                if not is_complete_jpeg(os.path.join(deployment_path, image_name)):
+                                    raise IOError('truncated JPEG')
+                            else:
+                                Image.open(os.path.join(deployment_path, image_name)).verify()
                             good_image_count = good_image_count + 1
                         except:
                             bad_image_count = bad_image_count + 1
@@ -400,16 +565,20 @@ def check_deployment(deployment_path):
             return False
 
 
-def scan_deployment(deployment_path):
+def scan_deployment(deployment_path, image_data=None, deployment_info=None):
     """Scan deployment for data constraints found in images.csv
     returns a dict of the data needed for the deployment POST
+    image_data and deployment_info are read from the deployment's files unless given. The short name
+    is deployment_info's short_name if it has one, otherwise the name of the deployment directory
     """
     deployment_post_data = {}
 
-    deployment_info = read_deployment_file(deployment_path)
+    if deployment_info is None:
+        deployment_info = read_deployment_file(deployment_path)
 
     print 'MESSAGE: Scanning', deployment_path
-    image_data = read_images_file(deployment_path)
+    if image_data is None:
+        image_data = read_images_file(deployment_path)
 
     # need to find the first image with a lat long
     first_valid_image = None
@@ -454,10 +623,7 @@ def scan_deployment(deployment_path):
     deployment_post_data['start_time_stamp'] = first_valid_image['time']
     deployment_post_data['end_time_stamp'] = image_data[-1]['time']
 
-    if deployment_path[-1] == '/':
-        deployment_post_data['short_name'] = deployment_path.split('/')[-2]
-    else:
-        deployment_post_data['short_name'] = deployment_path.split('/')[-1]
+    deployment_post_data['short_name'] = deployment_info.get('short_name') or get_deployment_short_name(deployment_path)
 
     deployment_post_data['mission_aim'] = deployment_info['description']
     deployment_post_data['min_depth'] = str(depth_array.min())
@@ -470,6 +636,15 @@ def scan_deployment(deployment_path):
     return deployment_post_data
 
 
+def get_deployment_short_name(deployment_path):
+    """The deployment short name is the name of its directory
+    """
+    if deployment_path[-1] == '/':
+        return deployment_path.split('/')[-2]
+    else:
+        return deployment_path.split('/')[-1]
+
+
 def get_camera_data(image_data):
     """ checks images list for the camera a returns a dict for posting
         Note: will eventually handle the multiple camera case, if we ever see a deployment with such.
@@ -690,20 +865,35 @@ def post_campaign_to_server(root_import_path, server_root, user_name, api_key):
     # a previously incomplete upload.  In that case we find out which current campaign matches
     # the campaign we get from the campaign.txt and move on.
 
+    campaign_key = campaign_data['short_name'] + '|' + campaign_data['date_start']
+
     print 'SENDING: Campaign info...'
 
     headers = {'Content-type': 'application/json'}
 
-    r = requests.post(url, data=json.dumps(campaign_data), headers=headers, params=params)
-    if r.status_code == requests.codes.created:
+    campaign_url = cached_uri('campaigns', campaign_key)
+    if campaign_url is not None and not uri_exists(campaign_url, params):
+        print 'WARNING: Cached campaign', campaign_url, 'is no longer on the server, sending it again'
+        drop_cached_uri('campaigns', campaign_key)
+        campaign_url = None
+    if campaign_url is not None:
+        print 'MESSAGE: Resuming upload of', campaign_url, '(cached)'
+        r = None
+    else:
+        r = requests.post(url, data=json.dumps(campaign_data), headers=headers, params=params, timeout=request_timeout)
+
+    if r is None:
+        pass
+    elif r.status_code == requests.codes.created:
         campaign_url = r.headers['location']
         print 'SUCCESS: Campaign header data uploaded:', campaign_url
+        cache_uri('campaigns', campaign_key, urlparse.urlsplit(campaign_url).path)
     elif duplicate_error_message.lower() in r.text.lower():
         url = urlparse.urljoin(server_root, campaign_api_path)
         params['short_name'] = campaign_data['short_name']
         params['date_start'] = campaign_data['date_start']
 
-        r = requests.get(url, headers=headers, params=params)
+        r = requests.get(url, headers=headers, params=params, timeout=request_timeout)
         if r.status_code != requests.codes.ok:
             print 'FAILED: server API problem detected for', url
             print 'MESSAGE: Full message from server follows:'
@@ -711,15 +901,17 @@ def post_campaign_to_server(root_import_path, server_root, user_name, api_key):
             return False
         else:
             # we need the request to return 1 object.  If there is more than 1 (or 0) something is wrong
-            if len(r.json()) > 1 or len(r.json()) == 0:
-                print 'FAILED: Expected to find one matching campaign, but found', len(r.json())
-                for jsonentry in r.json():
+            matches = r.json()['objects']
+            if len(matches) != 1:
+                print 'FAILED: Expected to find one matching campaign, but found', len(matches)
+                for jsonentry in matches:
                     print 'check:', jsonentry['resource_uri']
                 print 'MESSAGE: You should contact the Catami team to sort this out.'
                 return False
 
-            campaign_url = r.json()[0]['resource_uri']
+            campaign_url = matches[0]['resource_uri']
             print 'MESSAGE: Resuming upload of', campaign_url
+            cache_uri('campaigns', campaign_key, urlparse.urlsplit(campaign_url).path)
     else:
         print 'FAILED: Server returned', r.status_code
         print 'MESSAGE: Full message from server follows:'
@@ -728,7 +920,7 @@ def post_campaign_to_server(root_import_path, server_root, user_name, api_key):
 
     #POST deployment/s
 
-    directories = [o for o in os.listdir(root_import_path) if os.path.isdir(os.path.join(root_import_path, o)) and not o.startswith('.')]
+    directories = list_directory(root_import_path)[0]
 
     for directory in directories:
         print 'SENDING: Deployment info for', directory
@@ -741,6 +933,7 @@ def post_campaign_to_server(root_import_path, server_root, user_name, api_key):
 def post_image_to_image_url(post_package):
     """Posts an image to the server using file POST
         If the file already exists, silently moves on.
+        Returns (status, status_code, response text). status_code is None if no request was made.
     """
 
     status = True
@@ -754,13 +947,20 @@ def post_image_to_image_url(post_package):
     params = dict(username=post_package['username'], api_key=post_package['user_apikey'])
 
     url = urlparse.urljoin(server_root, post_package['image_object_api_path'])
-    if os.path.isfile(os.path.join(post_package['deployment_path'], post_package['image_name'])):
-        image_file = {'img': open(os.path.join(post_package['deployment_path'], post_package['image_name']), 'rb')}
+    if post_package.get('image_data') is not None:
+        # already read by the read ahead stage
+        image_file = {'img': (os.path.basename(post_package['image_name']), post_package['image_data'])}
+    elif post_package.get('source_path') is not None:
+        image_file = {'img': (os.path.basename(post_package['image_name']), transcode_image(post_package))}
     else:
-        print 'FAILED: expect image missing at', os.path.join(post_package['deployment_path'], post_package['image_name'])
-        return False
+        # opened straight away, a missing image shows up as the open failing
+        try:
+            image_file = {'img': open(os.path.join(post_package['deployment_path'], post_package['image_name']), 'rb')}
+        except IOError:
+            print 'FAILED: expect image missing at', os.path.join(post_package['deployment_path'], post_package['image_name'])
+            return False, None, 'image file is missing'
 
-    r = requests.post(url, files=image_file, params=params, data=post_data)
+    r = requests.post(url, files=image_file, params=params, data=post_data, timeout=request_timeout)
 
     if duplicate_text_head in r.text and duplicate_text_tail in r.text:
         # this image already exists, we have nothing to do.
@@ -771,11 +971,366 @@ def post_image_to_image_url(post_package):
         print r.text
         status = False
 
-    return status
+    return status, r.status_code, r.text
+
+
+def transcode_image(post_package):
+    """JPEG data for an image that is still in its raw form at post_package['source_path'].
+        The JPEG is also saved in the deployment directory if post_package['local_copy'] is set.
+    """
+    # only --auv needs the converter (and scipy), so it is imported here
+    import auv_converter
+
+    if auv_converter.passthrough_image(post_package['source_path']) is not None:
+        # already a whole JPEG the server takes, send it as it is
+        with open(post_package['source_path'], 'rb') as f:
+            image_data = f.read()
+    else:
+        output = io.BytesIO()
+        auv_converter.load_image(post_package['source_path']).save(output, 'JPEG', quality=90)
+        image_data = output.getvalue()
+
+    if post_package.get('local_copy'):
+        image_path = os.path.join(post_package['deployment_path'], post_package['image_name'])
+        with open(image_path + '.tmp', 'wb') as f:
+            f.write(image_data)
+        os.rename(image_path + '.tmp', image_path)
+
+    return image_data
 
 
-def post_deployment_to_server(deployment_path, server_root, username, user_apikey, campaign_url):
+def post_image_task(task):
+    """Pool worker for post_image_to_image_url. task is an (index, post_package) tuple.
+        Timeouts, connection errors and server errors are retried up to max_upload_attempts times.
+        Returns (index, result) so results can be matched to images as they complete out of order,
+        result being a dict of status, status_code, response and attempts.
+        Never raises, any exception is reported as a failed upload.
+    """
+    index, post_package = task
+    result = dict(status=False, status_code=None, response='', attempts=0)
+
+    # transcode once rather than on every attempt
+    if post_package.get('source_path') is not None and post_package.get('image_data') is None:
+        try:
+            post_package = dict(post_package, image_data=transcode_image(post_package))
+        except Exception, e:
+            print 'FAILED: conversion of', post_package['source_path'], 'raised', e
+            result['response'] = str(e)
+            return index, result
+
+    while result['attempts'] < max_upload_attempts:
+        if result['attempts'] > 0:
+            time.sleep(2 ** result['attempts'])
+        result['attempts'] += 1
+        try:
+            result['status'], result['status_code'], result['response'] = post_image_to_image_url(post_package)
+        except Exception, e:
+            print 'FAILED: upload of', post_package['image_name'], 'raised', e
+            result['status'], result['status_code'], result['response'] = False, None, str(e)
+            continue
+
+        # only server side errors are worth another try
+        if result['status'] or result['status_code'] is None or result['status_code'] < 500:
+            break
+
+    return index, result
+
+
+class ReadAheadBuffer:
+    """Bounds the number of bytes read from disk but not yet sent to the server.
+
+    A file bigger than the whole buffer is still let in once the buffer is empty,
+    so a single huge image cannot deadlock the upload. stop() wakes up and turns
+    away the reader when the upload is abandoned.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+
+    def acquire(self, size):
+        """Blocks until size bytes fit in the buffer. Returns False if the buffer was stopped instead."""
+        with self.condition:
+            while not self.stopping.is_set() and self.used > 0 and self.used + size > self.max_bytes:
+                self.condition.wait()
+            if self.stopping.is_set():
+                return False
+            self.used += size
+            return True
+
+    def stop(self):
+        with self.condition:
+            self.stopping.set()
+            self.condition.notify_all()
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+def disk_order(image_list_for_posting):
+    """Returns (index, post_package) tuples sorted by inode, a cheap stand in for on-disk placement.
+        Files that can't be stat'ed are left at the end for the upload worker to report.
+    """
+    keyed = []
+    for index, post_package in enumerate(image_list_for_posting):
+        try:
+            info = os.stat(post_package.get('source_path') or os.path.join(post_package['deployment_path'], post_package['image_name']))
+            key = (info.st_dev, info.st_ino)
+        except OSError:
+            key = (float('inf'), index)
+        keyed.append((key, index, post_package))
+    keyed.sort()
+
+    return [(index, post_package) for key, index, post_package in keyed]
+
+
+def read_ahead(tasks, pool, buffer, sizes, callback):
+    """Reads image files one after another and hands them, with their data, to the upload pool.
+        Runs in its own thread so disk reads overlap the uploads. Closes the pool when every task is submitted,
+        or gives up as soon as the buffer is stopped.
+    """
+    for index, post_package in tasks:
+        if buffer.stopping.is_set():
+            return
+        image_path = os.path.join(post_package['deployment_path'], post_package['image_name'])
+        if post_package.get('source_path') is not None:
+            # raw images are transcoded by the upload workers, one each at a time
+            image_data = None
+        else:
+            try:
+                with open(image_path, 'rb') as f:
+                    image_data = f.read()
+            except IOError:
+                # leave it to the upload worker to report the missing image
+                image_data = None
+
+        size = len(image_data) if image_data is not None else 0
+        if not buffer.acquire(size):
+            return
+        sizes[index] = size
+
+        post_package = dict(post_package)
+        post_package['image_data'] = image_data
+        try:
+            pool.apply_async(post_image_task, ((index, post_package),), callback=callback)
+        except ValueError:
+            # the pool was terminated under us
+            return
+
+    pool.close()
+
+
+def upload_images(image_list_for_posting, processes=10):
+    """POSTs a list of image packages to the server with a pool of workers while watching for
+        stalled uploads and, if enabled, hedging the slowest stragglers.
+        Image files are read sequentially ahead of the workers, in read_order, into a bounded buffer.
+        Returns a dict of list index -> result (see post_image_task). Images that never completed
+        because the upload stalled are missing from the dict.
+    """
+    num_tasks = len(image_list_for_posting)
+    results = {}
+    done = Queue.Queue()
+
+    buffer = ReadAheadBuffer(prefetch_bytes)
+    sizes = {}
+
+    def upload_done(result):
+        # runs in the pool's result thread, frees the image's space in the read ahead buffer
+        buffer.release(sizes.pop(result[0], 0))
+        done.put(result)
+
+    if read_order == 'disk':
+        tasks = disk_order(image_list_for_posting)
+    else:
+        tasks = list(enumerate(image_list_for_posting))
+
+    pbar = ProgressBar(widgets=[Percentage(), Bar(), Timer()], maxval=max(num_tasks, 1)).start()
+    pool = Pool(processes=processes)
+    reader = threading.Thread(target=read_ahead, args=(tasks, pool, buffer, sizes, upload_done))
+    reader.daemon = True
+    reader.start()
+
+    hedge_pool = None
+    hedge_tail = max(1, int(num_tasks * hedge_fraction))
+    start_time = time.time()
+    last_completion = start_time
+    recent_completions = deque()
+    stalled = False
+
+    while len(results) < num_tasks:
+        try:
+            index, result = done.get(timeout=0.5)
+            now = time.time()
+            if index in results:
+                # a hedged duplicate, either copy succeeding is good enough
+                result['attempts'] += results[index]['attempts']
+                if results[index]['status']:
+                    results[index]['attempts'] = result['attempts']
+                else:
+                    results[index] = result
+            else:
+                results[index] = result
+                last_completion = now
+                recent_completions.append(now)
+                pbar.update(len(results))
+        except Queue.Empty:
+            now = time.time()
+
+        # watchdog: is the upload still moving fast enough?
+        while recent_completions and recent_completions[0] < now - stall_window:
+            recent_completions.popleft()
+        outstanding = num_tasks - len(results)
+        if now - start_time > stall_window and len(recent_completions) < min(min_upload_rate * stall_window, 0.5 * outstanding):
+            print
+            print 'FAILED: Upload stalled,', len(recent_completions), 'images completed in the last', int(stall_window), 'seconds'
+            stalled = True
+            break
+
+        # hedge the stragglers at the tail end of the deployment
+        remaining = num_tasks - len(results)
+        if use_hedging and hedge_pool is None and remaining <= hedge_tail and now - last_completion > hedge_delay:
+            print
+            print 'MESSAGE: Sending hedged requests for', remaining, 'slow images'
+            hedge_pool = Pool(processes=min(remaining, processes))
+            for task in enumerate(image_list_for_posting):
+                if task[0] not in results:
+                    hedge_pool.apply_async(post_image_task, (task,), callback=upload_done)
+            hedge_pool.close()
+
+    pbar.finish()
+
+    if stalled or hedge_pool is not None:
+        # stop the reader before the pool it feeds goes away. After hedging every image has a
+        # result, the primary workers may still be waiting on the slow copies
+        buffer.stop()
+        reader.join(connect_timeout)
+        pool.terminate()
+    else:
+        reader.join()
+        pool.join()
+
+    # any hedged duplicates still in flight are no longer needed
+    if hedge_pool is not None:
+        hedge_pool.terminate()
+
+    return results
+
+
+def write_dead_letters(deployment_path, image_list_for_posting, results, unsent_response='upload stalled', merge=False):
+    """Writes every image of image_list_for_posting that did not upload to the deployment's
+        dead letter file, or removes the file if they all made it. With deployment_path None
+        nothing is written and the failed images are only listed. Images without a result are
+        recorded with unsent_response. With merge set the images already in the file that are not
+        in image_list_for_posting are kept, so a partial upload does not lose earlier failures.
+        Returns the number of failed images of image_list_for_posting.
+    """
+    failed = []
+
+    for index, post_package in enumerate(image_list_for_posting):
+        result = results.get(index)
+        if result is None:
+            result = dict(status=False, status_code=None, response=unsent_response, attempts=0)
+        if not result['status']:
+            # keep the excerpt to one short line
+            response = ' '.join(result['response'].split())[:200]
+            if isinstance(response, unicode):
+                response = response.encode('utf-8')
+            failed.append([post_package['image_name'],
+                           post_package['deployment'],
+                           result['status_code'] if result['status_code'] is not None else '',
+                           result['attempts'],
+                           response])
+
+    if deployment_path is None:
+        for row in failed:
+            print 'FAILED:', row[0], 'did not upload -', row[4]
+        return len(failed)
+
+    kept = []
+    if merge:
+        posted_names = set([post_package['image_name'] for post_package in image_list_for_posting])
+        kept = [[dead_letter[field] for field in ['image_name', 'deployment', 'status_code', 'attempts', 'response']]
+                for dead_letter in read_dead_letters(deployment_path) if dead_letter['image_name'] not in posted_names]
+
+    dead_letter_path = os.path.join(deployment_path, dead_letter_filename)
+    if len(kept) + len(failed) == 0:
+        if os.path.isfile(dead_letter_path):
+            os.remove(dead_letter_path)
+        return 0
+
+    with open(dead_letter_path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(dead_letter_headers)
+        writer.writerows(kept)
+        writer.writerows(failed)
+    if len(failed) > 0:
+        print 'MESSAGE:', len(failed), 'failed images recorded in', dead_letter_path
+
+    return len(failed)
+
+
+def read_dead_letters(deployment_path):
+    """reads the deployment's dead letter file, returns a list of dicts (empty if there is no file)
+    """
+    dead_letters = []
+    dead_letter_path = os.path.join(deployment_path, dead_letter_filename)
+
+    if os.path.isfile(dead_letter_path):
+        with open(dead_letter_path, 'rb') as csvfile:
+            dead_letter_reader = csv.reader(csvfile)
+            #skip the header row
+            dead_letter_reader.next()
+            for row in dead_letter_reader:
+                dead_letters.append(dict(image_name=row[0],
+                                         deployment=row[1],
+                                         status_code=row[2],
+                                         attempts=row[3],
+                                         response=row[4]))
+
+    return dead_letters
+
+
+def redrive_deployment(deployment_path, username, user_apikey):
+    """Re-uploads only the images recorded in the deployment's dead letter file.
+        The image metadata is already on the server, only the image files are sent.
+    """
+    image_object_api_path = '/api/dev/image_upload/'
+
+    dead_letters = read_dead_letters(deployment_path)
+    if len(dead_letters) == 0:
+        print 'MESSAGE: No failed images to re-upload in', deployment_path
+        return True
+
+    print 'MESSAGE: Re-uploading', len(dead_letters), 'failed images from', deployment_path
+
+    image_list_for_posting = []
+    for dead_letter in dead_letters:
+        image_list_for_posting.append(dict(image_name=dead_letter['image_name'],
+                                           deployment=dead_letter['deployment'],
+                                           deployment_path=deployment_path,
+                                           image_object_api_path=image_object_api_path,
+                                           username=username,
+                                           user_apikey=user_apikey))
+
+    results = upload_images(image_list_for_posting)
+
+    failed_count = write_dead_letters(deployment_path, image_list_for_posting, results)
+    if failed_count > 0:
+        print 'FAILED:', failed_count, 'of', len(image_list_for_posting), 'images still failed to upload'
+        return False
+
+    print 'SUCCESS:', len(image_list_for_posting), 'Images uploaded'
+    return True
+
+
+def post_deployment_to_server(deployment_path, server_root, username, user_apikey, campaign_url, image_data=None, deployment_info=None, keep_records=True):
     """Iterates through campaign directory POSTing data/imagery to the API at a specified Catami server
+        image_data and deployment_info are read from the deployment's files unless given, see scan_deployment
+        for the deployment's short name
     """
 
     deployment_api_path = '/api/dev/deployment/'
@@ -805,22 +1360,39 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
 
     url = urlparse.urljoin(server_root, deployment_api_path)
     params = dict(username=username, api_key=user_apikey)
+    headers = {'Content-type': 'application/json'}
 
-    #get deployment data for POST
+    # short names are only unique within a campaign
+    short_name = (deployment_info or {}).get('short_name') or get_deployment_short_name(deployment_path)
+    deployment_key = urlparse.urlsplit(campaign_url).path + '|' + short_name
+    cached_deployment = cached_uri('deployments', deployment_key)
+    if cached_deployment is not None and not uri_exists(cached_deployment['uri'], params):
+        print 'WARNING: Cached deployment', cached_deployment['uri'], 'is no longer on the server, sending it again'
+        drop_cached_uri('deployments', deployment_key)
+        cached_deployment = None
+
+    if cached_deployment is not None:
+        deployment_url = cached_deployment['uri']
+        print 'MESSAGE: Resuming upload of', deployment_url, '(cached)'
+        r = None
+    else:
+        #get deployment data for POST
 
-    deployment_post_data = scan_deployment(deployment_path)
-    if deployment_post_data is None:
-        print 'FAILED: Deployment scan failed'
-        return False
+        deployment_post_data = scan_deployment(deployment_path, image_data, deployment_info)
+        if deployment_post_data is None:
+            print 'FAILED: Deployment scan failed'
+            return False
 
-    #add the camppaign, the deployment doesn't really know about it
-    deployment_post_data['campaign'] = campaign_url
+        #add the camppaign, the deployment doesn't really know about it
+        deployment_post_data['campaign'] = campaign_url
 
-    #POST deployment data
-    print 'SENDING: Deployment info...'
-    headers = {'Content-type': 'application/json'}
-    r = requests.post(url, data=json.dumps(deployment_post_data), headers=headers, params=params)
-    if (r.status_code == requests.codes.created):
+        #POST deployment data
+        print 'SENDING: Deployment info...'
+        r = requests.post(url, data=json.dumps(deployment_post_data), headers=headers, params=params, timeout=request_timeout)
+
+    if r is None:
+        pass
+    elif (r.status_code == requests.codes.created):
         deployment_url = r.headers['location']
         print 'SUCCESS: Deployment header data uploaded:', urlparse.urlsplit(deployment_url).path
     elif duplicate_error_message.lower() in r.text.lower():
@@ -828,7 +1400,7 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
 
         params['short_name'] = deployment_post_data['short_name']
 
-        r = requests.get(url, headers=headers, params=params)
+        r = requests.get(url, headers=headers, params=params, timeout=request_timeout)
         if r.status_code != requests.codes.ok:
             print 'FAILED: server API problem detected for', url
             print 'MESSAGE: Full message from server follows:'
@@ -836,23 +1408,105 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
             return False
         else:
             # we need the request to return 1 object.  If there is more than 1 (or 0) something is wrong
-            if len(r.json()) > 2 or len(r.json()) == 0:
-                print 'FAILED: Expected to find one matching deployment, but found', len(r.json())
-                for jsonentry in r.json():
+            matches = r.json()['objects']
+            if len(matches) != 1:
+                print 'FAILED: Expected to find one matching deployment, but found', len(matches)
+                for jsonentry in matches:
                     print 'check:', jsonentry['resource_uri']
                 print 'MESSAGE: You should contact the Catami team to sort this out.'
                 return False
 
-            deployment_url = r.json()['objects'][0]['resource_uri']
+            deployment_url = matches[0]['resource_uri']
             print 'MESSAGE: Resuming upload of', deployment_url
     else:
         print 'FAILED: Server returned', r.status_code
         print 'MESSAGE: Full message from server follows:'
         return False
 
+    if cached_deployment is None:
+        cache_uri('deployments', deployment_key, dict(uri=urlparse.urlsplit(deployment_url).path,
+                                                      id=deployment_url.split('/')[-2]))
+
     # POST images for deployment
 
-    image_data = read_images_file(deployment_path)
+    if image_data is None:
+        image_data = read_images_file(deployment_path)
+
+    status, uploaded = post_image_data(deployment_path, image_data, deployment_url, server_root, username, user_apikey, keep_records)
+
+    # remember what went up, for --delta
+    if keep_records and len(uploaded) > 0:
+        snapshot = {}
+        for current_image in image_data:
+            if current_image['image_name'] in uploaded:
+                snapshot[current_image['image_name']] = dict(uploaded[current_image['image_name']],
+                                                             row_hash=image_row_hash(current_image))
+        write_snapshot(deployment_path, deployment_url, snapshot)
+
+    return status
+
+
+def post_auv_deployment_to_server(auv_path, server_root, username, user_apikey, campaign_url, local_copy=None):
+    """Converts a raw AUV dive and uploads it in one pass. The images.csv rows are made in memory
+        and each GeoTIFF is transcoded to JPEG by the upload worker that sends it, so no converted
+        copy of the dive is needed on disk. With local_copy a Catami format copy is written there as
+        well, and it holds the upload records (failed_images.csv etc). Otherwise no records are kept,
+        the raw dive directory is left as it is.
+    """
+    # only --auv needs the converter (and scipy), so it is imported here
+    import auv_converter
+
+    print 'MESSAGE: Importing AUV dive', auv_path
+    files = auv_converter.AUVImporter.dependency_get(auv_path)
+    auvdeployment, image_list = auv_converter.auvdeployment_import(files)
+    if image_list is None:
+        print 'FAILED: No images to upload in', auv_path
+        return False
+
+    short_name = auv_converter.deployment_short_name(auv_path)
+    deployment_path = auv_path
+    if local_copy is not None:
+        if not os.path.isdir(local_copy):
+            os.makedirs(local_copy)
+        auv_converter.write_description(local_copy, short_name)
+        auv_converter.write_images_file(local_copy, image_list)
+        deployment_path = local_copy
+
+    # images.csv rows as read_images_file would return them
+    image_data = []
+    for row, image in zip(auv_converter.image_rows(image_list), image_list):
+        current_image = dict(zip(image_fields, [repr(value) if isinstance(value, float) else str(value) for value in row]))
+        current_image['depth_uncertainty'] = 'None'
+        current_image['source_path'] = image['image_path']
+        current_image['local_copy'] = local_copy is not None
+        image_data.append(current_image)
+
+    # the dive's name, whatever the --local_copy directory is called
+    deployment_info = dict(type='AUV', description=short_name+' Imported AUV', operator='', keywords='', short_name=short_name)
+
+    if local_copy is None:
+        print 'WARNING: Without --local_copy failed images are not recorded for --redrive'
+
+    return post_deployment_to_server(deployment_path, server_root, username, user_apikey, campaign_url,
+                                     image_data=image_data, deployment_info=deployment_info, keep_records=local_copy is not None)
+
+
+def post_image_data(deployment_path, image_data, deployment_url, server_root, username, user_apikey, keep_records=True, merge_records=False):
+    """POSTs image metadata, camera and measurement metadata and then the images themselves for
+        a list of images.csv rows (as returned by read_images_file) belonging to deployment_url.
+        Returns (status, uploaded). uploaded maps image name -> dict of image, camera and measurement
+        resource URIs for every image whose metadata reached the server.
+        Failed images are recorded in the deployment's dead letter file if keep_records is set,
+        alongside the failures already recorded there if merge_records is set.
+    """
+
+    image_metadata_api_path = '/api/dev/image/'
+    camera_api_path = '/api/dev/camera/'
+    measurement_api_path = '/api/dev/measurements/'
+    image_object_api_path = '/api/dev/image_upload/'
+
+    uploaded = {}
+    params = dict(username=username, api_key=user_apikey)
 
     #main image posting loop.
 
@@ -864,24 +1518,19 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
     # STEP 1: post image meta data
     for index, current_image in enumerate(image_data):
 
-        params = dict(username=username, api_key=user_apikey)
-
         # if the image has no lat/long we skip it here
         if str(current_image['latitude']).lower() == 'None'.lower() or str(current_image['longitude']).lower() == 'None'.lower():
             continue
 
         # STEP 1 post the image metadata
-        image_metadata = dict(web_location="",
-                              archive_location="None",
-                              image_name=current_image["image_name"],
-                              deployment=str(urlparse.urlsplit(deployment_url).path),
-                              date_time=current_image["time"],
-                              position="SRID=4326;POINT("+current_image["longitude"]+" "+current_image["latitude"]+")",
-                              depth=current_image["depth"],
-                              depth_uncertainty=current_image["depth_uncertainty"])
+        image_metadata = get_image_metadata(current_image, deployment_url)
         image_data_posted.append(current_image)
         list_for_posting.append(image_metadata);
 
+    if len(list_for_posting) == 0:
+        print 'MESSAGE: No images with a position to upload'
+        return True, uploaded
+
     print 'MESSAGE: [Step 1/4] Uploading image metadata to server'
     pbar = ProgressBar(widgets=[Percentage(), Bar(), Timer()], maxval=len(image_data)).start()
 
@@ -891,17 +1540,22 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
     jsonlist  = {}
     jsonlist["objects"] = list_for_posting
 
-    r = requests.patch(url, data=json.dumps(jsonlist), headers=headers, params=params)
+    r = requests.patch(url, data=json.dumps(jsonlist), headers=headers, params=params, timeout=bulk_request_timeout)
     if (r.status_code == requests.codes.accepted):
         print "SUCCESS: Image data was uploaded"
     else:
         print 'FAILED: Server returned', r.status_code
         print 'MESSAGE: Full message from server follows:'
         print r.text
-        return False
+        return False, uploaded
     pbar.finish()
 
     created_image_objects = json.loads(r.text)['objects']
+
+    for index, current_image in enumerate(image_data_posted):
+        uploaded[current_image['image_name']] = dict(image=urlparse.urlsplit(created_image_objects[index]['resource_uri']).path,
+                                                     camera='',
+                                                     measurement='')
      
     print 'MESSAGE: [Step 2/5] Preparing camera/measurement metadata'
     
@@ -914,21 +1568,15 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
         camera_data = get_camera_data(current_image)
         if camera_data is None:
             print 'FAILED: Could not get camera data for deployment'
-            return False
+            return False, uploaded
         # add the image api url for camera
         camera_data['image'] = urlparse.urlsplit(created_image_objects[index]['resource_uri']).path
         camera_list_for_post.append(camera_data)
         
-        measurement_data = dict(image=urlparse.urlsplit(created_image_objects[index]['resource_uri']).path,
-                                temperature=current_image['temperature'],
-                                salinity=current_image['salinity'],
-                                pitch=current_image['pitch'],
-                                roll=current_image['roll'],
-                                yaw=current_image['yaw'],
-                                altitude=current_image['altitude'])
+        measurement_data = get_measurement_data(current_image, urlparse.urlsplit(created_image_objects[index]['resource_uri']).path)
         measurement_list_for_post.append(measurement_data)
 
-        data_package = current_image
+        data_package = dict(current_image)
 
         data_package['deployment'] = deployment_url.split('/')[-2]
         data_package['deployment_path'] = deployment_path
@@ -946,7 +1594,7 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
     jsonlist["objects"] = camera_list_for_post
     url = urlparse.urljoin(server_root, camera_api_path)
     headers = {'Content-type': 'application/json'}
-    r = requests.patch(url, data=json.dumps(jsonlist), headers=headers, params=params)
+    r = requests.patch(url, data=json.dumps(jsonlist), headers=headers, params=params, timeout=bulk_request_timeout)
     pbar.finish()
     if (r.status_code == requests.codes.accepted):
         print 'SUCCESS: Camera metadata uploaded'
@@ -954,7 +1602,9 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
         print 'FAILED: Server returned', r.status_code
         print 'MESSAGE: Full message from server follows:'
         print r.text
-        return False
+        return False, uploaded
+
+    record_created_uris(uploaded, image_data_posted, r, 'camera')
 
     print 'MESSAGE: [Step 4/5] Uploading measurement metadata to server'
     pbar = ProgressBar(widgets=[Percentage(), Bar(), Timer()], maxval=len(image_data)).start()
@@ -962,7 +1612,7 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
     jsonlist["objects"] = measurement_list_for_post
     url = urlparse.urljoin(server_root, measurement_api_path)
     headers = {'Content-type': 'application/json'}
-    r = requests.patch(url, data=json.dumps(jsonlist), headers=headers, params=params)
+    r = requests.patch(url, data=json.dumps(jsonlist), headers=headers, params=params, timeout=bulk_request_timeout)
     pbar.finish()
     if (r.status_code == requests.codes.accepted):
         print 'SUCCESS: Measurement metadata uploaded'
@@ -970,45 +1620,306 @@ def post_deployment_to_server(deployment_path, server_root, username, user_apike
         print 'FAILED: Server returned', r.status_code
         print 'MESSAGE: Full message from server follows:'
         print r.text
-        return False
+        return False, uploaded
 
-    # need to upload one image first so that the deployment directory is created on the server
-    status = post_image_to_image_url(image_list_for_posting[0])
+    record_created_uris(uploaded, image_data_posted, r, 'measurement')
 
-    if not status:
+    dead_letter_path = deployment_path if keep_records else None
+
+    # need to upload one image first so that the deployment directory is created on the server.
+    # It is retried and dead lettered like the rest
+    results = dict([post_image_task((0, image_list_for_posting[0]))])
+
+    if not results[0]['status']:
+        write_dead_letters(dead_letter_path, image_list_for_posting, results, 'not sent, the first image failed to upload', merge_records)
         print 'FAILED: Image upload does not appear to be working. Contact a Catami admin or check your Catami Server'
-        return False
+        return False, uploaded
 
     print 'MESSAGE: [Step 5/5] Uploading images to server...'
-    pbar = ProgressBar(widgets=[Percentage(), Bar(), Timer()], maxval=len(image_list_for_posting)).start()
-    pool = Pool(processes=10)
-    rs = pool.imap_unordered(post_image_to_image_url, image_list_for_posting[1:])
-    pool.close()
-
-    num_tasks = len(image_list_for_posting) - 1
-    while (True):
-        pbar.update(rs._index)
-        if (rs._index == num_tasks):
-            break
-        time.sleep(0.5)
-    pbar.finish()
+    for index, result in upload_images(image_list_for_posting[1:]).items():
+        results[index + 1] = result
 
-    processed_tasks = len(list(rs))
+    num_tasks = len(image_list_for_posting)
+    failed_tasks = write_dead_letters(dead_letter_path, image_list_for_posting, results, merge=merge_records)
+    processed_tasks = num_tasks - failed_tasks
 
     if processed_tasks < num_tasks:
-        print 'FAILED: processed',processed_tasks+1,'of',num_tasks+1,'...Something went wrong'
-        return False
+        print 'FAILED: processed',processed_tasks,'of',num_tasks,'...Something went wrong'
+        print 'MESSAGE: Re-run with --redrive to upload just the failed images'
+        return False, uploaded
+
+    print 'SUCCESS:',processed_tasks,'Images uploaded'
+
+    return True, uploaded
+
+
+def get_image_metadata(current_image, deployment_url):
+    """ image metadata dict for posting, from an images.csv row
+    """
+    return dict(web_location="",
+                archive_location="None",
+                image_name=current_image["image_name"],
+                deployment=str(urlparse.urlsplit(deployment_url).path),
+                date_time=current_image["time"],
+                position="SRID=4326;POINT("+current_image["longitude"]+" "+current_image["latitude"]+")",
+                depth=current_image["depth"],
+                depth_uncertainty=current_image["depth_uncertainty"])
+
+
+def get_measurement_data(current_image, image_uri):
+    """ measurement dict for posting, from an images.csv row and the image's resource URI
+    """
+    return dict(image=image_uri,
+                temperature=current_image['temperature'],
+                salinity=current_image['salinity'],
+                pitch=current_image['pitch'],
+                roll=current_image['roll'],
+                yaw=current_image['yaw'],
+                altitude=current_image['altitude'])
+
+
+def record_created_uris(uploaded, image_data_posted, r, kind):
+    """ notes the resource URIs of the camera or measurement objects created by a list PATCH,
+        if the server returned them
+    """
+    try:
+        created_objects = r.json()['objects']
+    except (ValueError, KeyError, TypeError):
+        return
+
+    if len(created_objects) != len(image_data_posted):
+        return
+
+    for index, current_image in enumerate(image_data_posted):
+        uploaded[current_image['image_name']][kind] = urlparse.urlsplit(created_objects[index]['resource_uri']).path
+
+
+def image_row_hash(current_image):
+    """ hash of the images.csv fields of one image, used to spot changed rows
+    """
+    return hashlib.md5('\t'.join([current_image[field] for field in image_fields])).hexdigest()
+
+
+def write_snapshot(deployment_path, deployment_url, snapshot):
+    """ saves the row hash and server URIs of each uploaded image, for --delta.
+        snapshot is a dict of image name -> dict of row_hash, image, camera and measurement
+    """
+    with open(os.path.join(deployment_path, snapshot_filename), 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Deployment', urlparse.urlsplit(deployment_url).path])
+        writer.writerow(snapshot_headers)
+        for image_name in sorted(snapshot.keys()):
+            entry = snapshot[image_name]
+            writer.writerow([image_name,
+                             entry['row_hash'],
+                             entry['image'],
+                             entry['camera'],
+                             entry['measurement']])
+
+
+def read_snapshot(deployment_path):
+    """ reads the snapshot of the last upload. Returns (deployment url, dict of image name -> dict of
+        row hash and URIs), or None if the deployment hasn't been uploaded from here before
+    """
+    snapshot_path = os.path.join(deployment_path, snapshot_filename)
+    if not os.path.isfile(snapshot_path):
+        return None
+
+    snapshot = {}
+    with open(snapshot_path, 'rb') as csvfile:
+        snapshot_reader = csv.reader(csvfile)
+        deployment_url = snapshot_reader.next()[1]
+        #skip the header row
+        snapshot_reader.next()
+        for row in snapshot_reader:
+            snapshot[row[0]] = dict(row_hash=row[1],
+                                    image=row[2],
+                                    camera=row[3],
+                                    measurement=row[4])
+
+    return deployment_url, snapshot
+
+
+def lookup_uri(api_path, image_uri, params):
+    """ finds the resource URI of the camera or measurement object attached to an image
+    """
+    url = urlparse.urljoin(server_root, api_path)
+    lookup_params = dict(params)
+    lookup_params['image'] = image_uri.rstrip('/').split('/')[-1]
+    r = requests.get(url, params=lookup_params, timeout=request_timeout)
+    if r.status_code != requests.codes.ok or len(r.json()['objects']) != 1:
+        return ''
+
+    return urlparse.urlsplit(r.json()['objects'][0]['resource_uri']).path
+
+
+def patch_in_batches(api_path, objects, deleted_objects, params):
+    """ PATCHes objects (and deletes deleted_objects) at api_path, delta_batch_size at a time
+    """
+    url = urlparse.urljoin(server_root, api_path)
+    headers = {'Content-type': 'application/json'}
 
-    print 'SUCCESS:',processed_tasks+1,'Images uploaded'
+    for start in range(0, max(len(objects), len(deleted_objects)), delta_batch_size):
+        jsonlist = {}
+        jsonlist['objects'] = objects[start:start + delta_batch_size]
+        if len(deleted_objects[start:start + delta_batch_size]) > 0:
+            jsonlist['deleted_objects'] = deleted_objects[start:start + delta_batch_size]
+        r = requests.patch(url, data=json.dumps(jsonlist), headers=headers, params=params, timeout=bulk_request_timeout)
+        if r.status_code != requests.codes.accepted:
+            print 'FAILED: Server returned', r.status_code
+            print 'MESSAGE: Full message from server follows:'
+            print r.text
+            return False
 
     return True
 
 
+def delta_sync_deployment(deployment_path, server_root, username, user_apikey):
+    """Compares images.csv with the snapshot taken at the last upload and sends only the difference;
+        changed rows are PATCHed, new rows are uploaded and removed rows are deleted from the server.
+    """
+    image_metadata_api_path = '/api/dev/image/'
+    camera_api_path = '/api/dev/camera/'
+    measurement_api_path = '/api/dev/measurements/'
+
+    params = dict(username=username, api_key=user_apikey)
+
+    snapshot = read_snapshot(deployment_path)
+    if snapshot is None:
+        print 'FAILED: No record of a previous upload in', deployment_path, '- upload the deployment first'
+        return False
+    deployment_url, previous = snapshot
+
+    # an empty or missing images.csv would remove every image from the server
+    if not os.path.isfile(os.path.join(deployment_path, images_filename)):
+        print 'FAILED:', images_filename, 'is missing in', deployment_path
+        return False
+    image_data = read_images_file(deployment_path)
+    if len(image_data) == 0:
+        print 'FAILED:', images_filename, 'in', deployment_path, 'has no images'
+        return False
+    current_names = set([current_image['image_name'] for current_image in image_data])
+
+    added = [current_image for current_image in image_data if current_image['image_name'] not in previous]
+    changed = [current_image for current_image in image_data if current_image['image_name'] in previous
+               and previous[current_image['image_name']]['row_hash'] != image_row_hash(current_image)]
+    removed = [image_name for image_name in previous if image_name not in current_names]
+
+    print 'MESSAGE:', deployment_path, ':', len(added), 'added,', len(changed), 'changed,', len(removed), 'removed images'
+
+    if len(removed) > max_delete_fraction * len(previous) and not args.force_delete:
+        print 'FAILED:', len(removed), 'of the', len(previous), 'uploaded images are not in', images_filename, '- nothing was sent.'
+        print 'MESSAGE: Check the deployment path, or use --force_delete to remove them from the server'
+        return False
+
+    if len(added) == 0 and len(changed) == 0 and len(removed) == 0:
+        print 'SUCCESS: Deployment is already up to date'
+        return True
+
+    status = True
+
+    # the deployment's extents may have moved
+    deployment_post_data = scan_deployment(deployment_path)
+    if deployment_post_data is not None:
+        for key in ['campaign', 'short_name', 'type']:
+            del deployment_post_data[key]
+        headers = {'Content-type': 'application/json'}
+        r = requests.patch(urlparse.urljoin(server_root, deployment_url), data=json.dumps(deployment_post_data), headers=headers, params=params, timeout=request_timeout)
+        if r.status_code != requests.codes.accepted:
+            print 'FAILED: Server returned', r.status_code, 'updating deployment', deployment_url
+            status = False
+
+    if len(changed) > 0:
+        print 'SENDING: Changes to', len(changed), 'images...'
+        image_objects = []
+        camera_objects = []
+        measurement_objects = []
+        for current_image in changed:
+            uris = previous[current_image['image_name']]
+
+            image_metadata = get_image_metadata(current_image, deployment_url)
+            image_metadata['resource_uri'] = uris['image']
+            image_objects.append(image_metadata)
+
+            if not uris['camera']:
+                uris['camera'] = lookup_uri(camera_api_path, uris['image'], params)
+            camera_data = get_camera_data(current_image)
+            if uris['camera'] and camera_data is not None:
+                camera_data['image'] = uris['image']
+                camera_data['resource_uri'] = uris['camera']
+                camera_objects.append(camera_data)
+
+            if not uris['measurement']:
+                uris['measurement'] = lookup_uri(measurement_api_path, uris['image'], params)
+            if uris['measurement']:
+                measurement_data = get_measurement_data(current_image, uris['image'])
+                measurement_data['resource_uri'] = uris['measurement']
+                measurement_objects.append(measurement_data)
+            else:
+                print 'WARNING: Could not find the measurements for', current_image['image_name']
+
+        if patch_in_batches(image_metadata_api_path, image_objects, [], params) and \
+                patch_in_batches(camera_api_path, camera_objects, [], params) and \
+                patch_in_batches(measurement_api_path, measurement_objects, [], params):
+            for current_image in changed:
+                previous[current_image['image_name']]['row_hash'] = image_row_hash(current_image)
+            print 'SUCCESS: Image changes uploaded'
+        else:
+            status = False
+
+    if len(removed) > 0:
+        print 'SENDING: Removing', len(removed), 'images...'
+        if patch_in_batches(image_metadata_api_path, [], [previous[image_name]['image'] for image_name in removed], params):
+            for image_name in removed:
+                del previous[image_name]
+            print 'SUCCESS: Images removed'
+        else:
+            status = False
+
+    if len(added) > 0:
+        print 'SENDING:', len(added), 'new images...'
+        # the images that failed in earlier uploads stay in the dead letter file for --redrive
+        added_status, uploaded = post_image_data(deployment_path, added, deployment_url, server_root, username, user_apikey,
+                                                 merge_records=True)
+        for current_image in added:
+            if current_image['image_name'] in uploaded:
+                previous[current_image['image_name']] = dict(uploaded[current_image['image_name']],
+                                                             row_hash=image_row_hash(current_image))
+        status = status and added_status
+
+    # only what made it to the server goes in the snapshot, anything that failed shows up again next time
+    write_snapshot(deployment_path, deployment_url, previous)
+
+    return status
+
+
 def main():
     """main routine
     """
     problem_found = False
 
+    # re-upload previously failed images, or send metadata changes, only
+    if args.redrive or args.delta:
+        if args.campaign:
+            root_import_path = args.campaign[0]
+            directories = list_directory(root_import_path)[0]
+            deployment_paths = [os.path.join(root_import_path, directory) for directory in directories]
+        else:
+            deployment_paths = [args.deployment[0]]
+
+        redrive_status = True
+        for deployment_path in deployment_paths:
+            if args.delta and not delta_sync_deployment(deployment_path, server_root, username, apikey):
+                redrive_status = False
+            if args.redrive and not redrive_deployment(deployment_path, username, apikey):
+                redrive_status = False
+
+        if redrive_status:
+            print 'SUCCESS: Everything went just great!'
+        else:
+            print 'ERROR: Everything did not go just great :('
+        return
+
     #campaign import
     if args.campaign:
         if not args.validate:
@@ -1025,11 +1936,14 @@ def main():
             # if we are still going then all required files exist. Yay us!
             campaign_status = check_campaign(root_import_path)
 
-            directories = [o for o in os.listdir(root_import_path) if os.path.isdir(os.path.join(root_import_path, o)) and not o.startswith('.')]
+            # every deployment's files, listed and classified together
+            pool = metadata_pool()
+            inventory = scan_tree(pool, root_import_path)
+            pool.close()
 
-            for directory in directories:
+            for directory, entries in inventory.items():
                 deployment_status = check_deployment(os.path.join(root_import_path, directory))
-                deployment_status = check_deployment_images(os.path.join(root_import_path, directory))
+                deployment_status = check_deployment_images(os.path.join(root_import_path, directory), entries)
 
             print 'SUCCESS: All checks are done, campaign is ready to upload'
 
@@ -1042,6 +1956,14 @@ def main():
                 else:
                     print 'ERROR: Everything did not go just great :('
 
+    # convert and upload a raw AUV dive in one pass
+    if args.auv and not args.validate:
+        local_copy = args.local_copy[0] if args.local_copy else None
+        if post_auv_deployment_to_server(args.auv[0], server_root, username, apikey, args.campaign_api[0], local_copy):
+            print 'SUCCESS: Everything went just great!'
+        else:
+            print 'ERROR: Everything did not go just great :('
+
     # deployment import
     if args.deployment:
         deployment_dir = args.deployment[0]
@@ -1058,7 +1980,9 @@ def main():
 
         if not problem_found:
             deployment_status = check_deployment(deployment_dir)
-            deployment_status = check_deployment_images(deployment_dir)
+            pool = metadata_pool()
+            deployment_status = check_deployment_images(deployment_dir, scan_directory(pool, deployment_dir))
+            pool.close()
 
             if not args.validate:
                 if deployment_status:
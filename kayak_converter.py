@@ -28,19 +28,29 @@ v1.0 28/05/2013 markg@ivec.org
 """
 import os
 import os.path
-import imghdr
 import argparse
+import csv
 
 from datetime import datetime
 
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
+import numpy as np
+
+# for GPX track logs
+from xml.etree import cElementTree as ElementTree
+
+from catami_common import ImagesFileWriter, metadata_pool, harvest_metadata, scan_directory, scan_tree
 
 parser = argparse.ArgumentParser(description='Parse AIMS Kayak (GoPro) files to produce valid Catami project.')
 parser.add_argument('--path', nargs=1, help='Path to root Kayak data directory')
 parser.add_argument('--deployment', action='store_true', default=False, help='Convert the directory as a deployment, to be attached to an existing campaign')
 parser.add_argument('--depth', nargs=1, type=float, help='Depth estimate in metres for the entire set of images.')
 parser.add_argument('--depth_uncertainty', nargs=1, type=float, help='Depth uncertainty estimate in metres for the entire set of images.')
+parser.add_argument('--gps_log', nargs=1, help='GPS track log (GPX, or CSV with time, latitude and longitude columns) to position images that have no GPS EXIF data')
+parser.add_argument('--depth_log', nargs=1, help='Depth logger time series (CSV with time and depth columns), used in place of --depth where it covers an image')
+parser.add_argument('--clock_offset', nargs=1, type=float, default=[0.0], help='Seconds to add to the camera clock to get the log time, eg -36000 for a camera on AEST and a UTC log (default 0)')
+parser.add_argument('--max_gap', nargs=1, type=float, default=[60.0], help='Largest gap in seconds between an image and the log readings either side of it for a logged value to be used (default 60)')
+parser.add_argument('--no_cache', action='store_true', default=False, help='Read the EXIF data of every image again instead of using the metadata cache.')
+parser.add_argument('--workers', nargs=1, type=int, help='Number of images to read EXIF data from at once (default 8, more can help on network storage)')
 
 args = parser.parse_args()
 make_deployment = args.deployment
@@ -52,6 +62,8 @@ if not os.path.isdir(root_import_path):
     raise Exception('This is not a valid path. Check the path to your kayak data.')
 
 images_filename = 'images.csv'
+images_headers = ['Time', 'Latitude', 'Longitude', 'Depth', 'ImageName', 'CameraName', 'CameraAngle', 'Temperature (celcius)',
+                  'Salinity (psu)', 'Pitch (radians)', 'Roll (radians)', 'Yaw (radians)', 'Altitude (metres)', 'Depth Uncertainty (m)']
 description_filename = 'description.txt'
 campaign_filename = 'campaign.txt'
 
@@ -60,122 +72,185 @@ current_format_version = '1.0'
 fill_value = -999.
 
 
-#add boolean test for useful image class
-def is_image(image_path):
-    if imghdr.what(image_path) == 'jpeg' or imghdr.what(image_path) == 'png':
-        return True
-    else:
-        return False
-
-
-def get_exif_data(image):
-    """Returns a dictionary from the exif data of an PIL Image item. Also converts the GPS Tags"""
-    exif_data = {}
-    info = image._getexif()
-    if info:
-        for tag, value in info.items():
-            decoded = TAGS.get(tag, tag)
-            if decoded == "GPSInfo":
-                gps_data = {}
-                for gps_tag in value:
-                    sub_decoded = GPSTAGS.get(gps_tag, gps_tag)
-                    gps_data[sub_decoded] = value[gps_tag]
-                exif_data[decoded] = gps_data
-            else:
-                exif_data[decoded] = value
-    return exif_data
-
-
-def _convert_to_degress(value):
-    """Helper function to convert the GPS coordinates stored in the EXIF to degress in float format"""
-    deg_num, deg_denom = value[0]
-    d = float(deg_num) / float(deg_denom)
-
-    min_num, min_denom = value[1]
-    m = float(min_num) / float(min_denom)
-
-    sec_num, sec_denom = value[2]
-    s = float(sec_num) / float(sec_denom)
-    return d + (m / 60.0) + (s / 3600.0)
-
-
-def get_photo_datetime(image_name):
-    """Returns datetime.datetime for the photo collection time"""
-    image = Image.open(image_name)
-    info = image._getexif()
-    photo_datetime = None
-
-    if info:
-        for tag, value in info.items():
-            decoded = TAGS.get(tag, tag)
-            if decoded == "DateTimeOriginal":
-                photo_datetime = value
-
-    return photo_datetime
-
-
-def get_lat_lon(image_name):
-    """Returns the latitude and longitude, if available, from the provided exif_data (obtained through get_exif_data above)"""
-    image = Image.open(image_name)
-
-    exif_data = get_exif_data(image)
-
-    lat = None
-    lon = None
-
-    if "GPSInfo" in exif_data:
-        gps_info = exif_data["GPSInfo"]
-
-        gps_latitude = gps_info.get("GPSLatitude")
-        gps_latitude_ref = gps_info.get('GPSLatitudeRef')
-        gps_longitude = gps_info.get('GPSLongitude')
-        gps_longitude_ref = gps_info.get('GPSLongitudeRef')
-        if gps_latitude and gps_latitude_ref and gps_longitude and gps_longitude_ref:
-            lat = _convert_to_degress(gps_latitude)
-            if gps_latitude_ref != "N":
-                lat *= -1
-
-            lon = _convert_to_degress(gps_longitude)
-            if gps_longitude_ref != "E":
-                lon *= -1
-
-    return lat, lon
-
-
-def get_camera_makemodel(image_name):
-    """Returns a camera make and model from the exif data of an PIL Image item."""
-    image = Image.open(image_name)
-    info = image._getexif()
-    if info:
-        make = None
-        model = None
-        for tag, value in info.items():
-            decoded = TAGS.get(tag, tag)
-            if decoded == "Model":
-                model = value.strip()
-            if decoded == "Make":
-                make = value.strip()
-        make_model_string = make+model
+def get_camera_makemodel(metadata):
+    """Returns a camera make and model from the metadata of read_image_metadata."""
+    if metadata['exif']:
+        make_model_string = (metadata['make'] or '')+(metadata['model'] or '')
     else:
         make_model_string = 'null'
 
     return make_model_string
 
 
-def convert_deployment(root_import_path, directory):
-    """converts a given directory to a deployment
+# names a CSV log's columns can go by, lower case
+log_column_names = {'time': ['time', 'datetime', 'date_time', 'timestamp'],
+                    'latitude': ['latitude', 'lat'],
+                    'longitude': ['longitude', 'lon', 'long', 'lng'],
+                    'depth': ['depth', 'depth (m)']}
+
+
+def decode_times(texts):
+    """Decode times, in bulk, to an array of unix seconds.
+
+    Takes EXIF (2013:05:16 09:10:11) and ISO 8601 (2013-05-16T09:10:11Z,
+    as in GPX files) times, with an optional fraction of a second. Times are
+    taken as they are, any time zone is left to --clock_offset. The fields are
+    sliced out at fixed offsets from a byte array of all the times at once.
+    Returns (times, valid), valid being False (with a time of 0) for times
+    that can't be read.
+    """
+    width = 32
+    count = len(texts)
+    if count == 0:
+        return np.zeros(0), np.zeros(0, dtype=bool)
+
+    chars = np.array([text.strip() for text in texts], dtype='S{0}'.format(width)).view(np.uint8).reshape(count, width)
+    is_digit = (chars >= ord('0')) & (chars <= ord('9'))
+    digits = chars.astype(np.int64) - ord('0')
+
+    def number(start, end):
+        value = np.zeros(count, dtype=np.int64)
+        for i in range(start, end):
+            value = value * 10 + digits[:, i]
+        return value
+
+    # YYYY?MM?DD?HH:MM:SS
+    valid = is_digit[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]].all(axis=1)
+    valid &= (chars[:, 13] == ord(':')) & (chars[:, 16] == ord(':'))
+
+    year = number(0, 4)
+    month = number(5, 7)
+    day = number(8, 10)
+    hour = number(11, 13)
+    minute = number(14, 16)
+    second = number(17, 19)
+
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) & (hour < 24) & (minute < 60) & (second < 61)
+    year[~valid] = 1970
+    month[~valid] = 1
+    day[~valid] = 1
+
+    # .ffffff
+    fraction_digits = np.cumprod(is_digit[:, 20:26], axis=1) * (chars[:, 19] == ord('.'))[:, np.newaxis]
+    fraction = (digits[:, 20:26] * fraction_digits * 10.0 ** -np.arange(1, 7)).sum(axis=1)
+
+    months = (year - 1970) * 12 + (month - 1)
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + (day - 1)
+
+    times = ((days * 24 + hour) * 60 + minute) * 60 + second + fraction
+    times[~valid] = 0
+
+    return times, valid
+
+
+def read_log_csv(path, names):
+    """The time column and the columns in names of a CSV log, found by their header names"""
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        header = [name.strip().lower() for name in reader.next()]
+
+        indexes = {}
+        for name in ['time'] + names:
+            matches = [header.index(alias) for alias in log_column_names[name] if alias in header]
+            if len(matches) == 0:
+                raise Exception('I didn\'t find a {0} column in {1}.'.format(name, path))
+            indexes[name] = matches[0]
+
+        rows = [row for row in reader if len(row) > max(indexes.values())]
+
+    columns = dict(time=[row[indexes['time']] for row in rows])
+    for name in names:
+        columns[name] = np.array([row[indexes[name]] for row in rows], dtype=float)
+
+    return columns
+
+
+def read_gpx(path):
+    """The times and positions of the track points of a GPX file, read as a stream"""
+    columns = dict(time=[], latitude=[], longitude=[])
+
+    for event, element in ElementTree.iterparse(path):
+        # tags carry the GPX namespace, {http://www.topografix.com/GPX/1/1}trkpt
+        if element.tag.endswith('trkpt'):
+            time = element.find(element.tag[:-len('trkpt')] + 'time')
+            if time is not None and time.text:
+                columns['time'].append(time.text)
+                columns['latitude'].append(float(element.get('lat')))
+                columns['longitude'].append(float(element.get('lon')))
+            element.clear()
+
+    columns['latitude'] = np.array(columns['latitude'], dtype=float)
+    columns['longitude'] = np.array(columns['longitude'], dtype=float)
+
+    return columns
+
+
+def read_log(path, names):
+    """A GPS or depth log as arrays: time (unix seconds, in time order) and each of names
     """
+    if os.path.splitext(path)[1].lower() == '.gpx':
+        columns = read_gpx(path)
+    else:
+        columns = read_log_csv(path, names)
+
+    times, valid = decode_times(columns['time'])
+    if not valid.all():
+        print 'WARNING: Ignoring', (~valid).sum(), 'readings with times that can\'t be read in', path
+
+    order = np.argsort(times[valid], kind='mergesort')
+    log = dict(time=times[valid][order])
+    for name in names:
+        log[name] = columns[name][valid][order]
+
+    print 'MESSAGE: Read', len(log['time']), 'readings from', path
+
+    return log
+
+
+def interpolate_log(log_times, log_values, times, max_gap):
+    """Linearly interpolate a log (times in order) to times, in bulk.
+
+    Times without a log reading within max_gap seconds on both sides (or an
+    exact match) get NaN.
+    """
+    if len(log_times) == 0:
+        return np.nan * np.ones(len(times))
+
+    later = np.searchsorted(log_times, times, side='left')
+    earlier = later - 1
+    inside = (later < len(log_times)) & (earlier >= 0)
+    later = np.clip(later, 0, len(log_times) - 1)
+    earlier = np.clip(earlier, 0, len(log_times) - 1)
+
+    covered = inside & (log_times[later] - times <= max_gap) & (times - log_times[earlier] <= max_gap)
+    covered |= log_times[later] == times
+
+    values = np.interp(times, log_times, log_values)
+    values[~covered] = np.nan
+
+    return values
+
 
+def start_harvest(pool, root_import_path, directory, entries):
+    """starts reading the metadata of every image in a directory
+        entries are the directory's files from scan_directory, only the JPEG and PNG ones are read
+        returns (image names in name order, Harvest of their metadata in the same order)
+    """
     image_dir = os.path.join(root_import_path, directory)
-    filelist = [o for o in os.listdir(image_dir) if os.path.isfile(os.path.join(image_dir, o))]
+    filelist = [entry.name for entry in entries if entry.kind in ('jpeg', 'png')]
 
-    if not os.path.isfile(os.path.join(image_dir, images_filename)):
-        with open(os.path.join(image_dir, images_filename), "w") as f:
-            version_string = 'version:'+current_format_version+'\n'
-            f.write(version_string)
-            headers = 'Time, Latitude, Longitude, Depth, ImageName, CameraName, CameraAngle, Temperature (celcius), Salinity (psu), Pitch (radians), Roll (radians), Yaw (radians), Altitude (metres), Depth Uncertainty (m)\n'
-            f.write(headers)
-    print 'Made', images_filename, 'in', directory
+    return filelist, harvest_metadata(pool, [os.path.join(image_dir, o) for o in filelist], use_cache=not args.no_cache)
+
+
+def convert_deployment(root_import_path, directory, harvest, gps_log=None, depth_log=None):
+    """converts a given directory to a deployment
+        harvest is the directory's file list and metadata from start_harvest
+        images without GPS EXIF data are positioned from gps_log, and depth_log replaces --depth
+        where it covers an image (logs from read_log)
+    """
+
+    image_dir = os.path.join(root_import_path, directory)
+    filelist, metadata_result = harvest
 
     # make the description file if it doesn't exist
     if not os.path.isfile(os.path.join(image_dir, description_filename)):
@@ -192,14 +267,46 @@ def convert_deployment(root_import_path, directory):
             f.write(Keyword_string)
     print 'Made', description_filename, 'in', directory
 
+    images = []
+    for image, metadata in zip(filelist, metadata_result.get()):
+        if metadata['kind'] in ('jpeg', 'png'):
+            if metadata['datetime'] is None:
+                print 'WARNING: No capture time in the EXIF data of', image, '- skipping it.'
+                continue
+            images.append((image, metadata))
+
+    latitudes = [metadata['latitude'] for image, metadata in images]
+    longitudes = [metadata['longitude'] for image, metadata in images]
+    depths = [args.depth[0] if args.depth else fill_value] * len(images)
+
+    if (gps_log is not None or depth_log is not None) and len(images) > 0:
+        # log time of each image
+        image_times = decode_times([metadata['datetime'] for image, metadata in images])[0] + args.clock_offset[0]
+
+        if gps_log is not None:
+            missing = np.array([latitude is None or longitude is None for latitude, longitude in zip(latitudes, longitudes)])
+            logged_latitudes = interpolate_log(gps_log['time'], gps_log['latitude'], image_times[missing], args.max_gap[0])
+            logged_longitudes = interpolate_log(gps_log['time'], gps_log['longitude'], image_times[missing], args.max_gap[0])
+            found = 0
+            for index, latitude, longitude in zip(np.flatnonzero(missing), logged_latitudes.tolist(), logged_longitudes.tolist()):
+                if not np.isnan(latitude):
+                    latitudes[index] = latitude
+                    longitudes[index] = longitude
+                    found += 1
+            print 'MESSAGE: Positioned', found, 'of', missing.sum(), 'images without GPS EXIF data from the GPS log'
+
+        if depth_log is not None:
+            logged_depths = interpolate_log(depth_log['time'], depth_log['depth'], image_times, args.max_gap[0])
+            for index, depth in enumerate(logged_depths.tolist()):
+                if not np.isnan(depth):
+                    depths[index] = depth
+
     count = 0
-    for image in filelist:
-        if is_image(os.path.join(image_dir, image)):
+    with ImagesFileWriter(os.path.join(image_dir, images_filename), current_format_version, images_headers) as writer:
+        for (image, metadata), latitude, longitude, depth in zip(images, latitudes, longitudes, depths):
             count = count + 1
-            latitude, longitude = get_lat_lon(os.path.join(image_dir, image))
-            depth = args.depth[0]
-            image_datetime = datetime.strptime(get_photo_datetime(os.path.join(image_dir, image)), '%Y:%m:%d %H:%M:%S')
-            camera_name = get_camera_makemodel(os.path.join(image_dir, image))
+            image_datetime = datetime.strptime(metadata['datetime'], '%Y:%m:%d %H:%M:%S')
+            camera_name = get_camera_makemodel(metadata)
             camera_angle = 'Downward'
             temperature = fill_value
             salinity = fill_value
@@ -208,22 +315,27 @@ def convert_deployment(root_import_path, directory):
             yaw_angle = fill_value
             altitude = fill_value
             depth_uncertainty = args.depth_uncertainty[0]
-            #append to csv
-            with open(os.path.join(image_dir, images_filename), "a") as f:
-                csv_string = unicode(image_datetime)+','+str(latitude)+','+str(longitude)+','+str(depth)+','+image+','+camera_name+','+camera_angle+','+str(temperature)+','+str(salinity)+','+str(pitch_angle)+','+str(roll_angle)+','+str(yaw_angle)+','+str(altitude)+','+str(depth_uncertainty)+'\n'
-                f.write(csv_string)
+            writer.write([unicode(image_datetime), latitude, longitude, depth, image, camera_name, camera_angle,
+                          temperature, salinity, pitch_angle, roll_angle, yaw_angle, altitude, depth_uncertainty])
+    print 'Made', images_filename, 'in', directory
     print 'Added ', count, 'entries in', directory, ":", images_filename
 
 
 def main():
     """Builds Catami format package for Kayak AIMS data
     """
+    # one pool reads the EXIF data of every directory
+    pool = metadata_pool(args.workers[0] if args.workers else None)
+
+    gps_log = read_log(args.gps_log[0], ['latitude', 'longitude']) if args.gps_log else None
+    depth_log = read_log(args.depth_log[0], ['depth']) if args.depth_log else None
 
     if make_deployment:
-        convert_deployment(root_import_path, '')
+        convert_deployment(root_import_path, '', start_harvest(pool, root_import_path, '', scan_directory(pool, root_import_path)), gps_log, depth_log)
     else:
-            #look for dirs in the root dir. Ignore pesky hidden dirs added by various naughty things
-        directories = [o for o in os.listdir(root_import_path) if os.path.isdir(os.path.join(root_import_path, o)) and not o.startswith('.')]
+            #look for dirs in the root dir, and the files in each. Ignore pesky hidden dirs added by various naughty things
+        inventory = scan_tree(pool, root_import_path)
+        directories = inventory.keys()
 
         if len(directories) == 0:
             raise Exception('I didn\'t find any directories to import. Check that the specified path contains kayak image directories.')
@@ -252,8 +364,13 @@ def main():
         print 'SUCCESS: Made', campaign_filename, 'in', root_import_path
         print 'MESSAGE: You need to manually edit the Campaign file prior to import.'
 
-        for directory in directories:
-            convert_deployment(root_import_path, directory)
+        # queue every directory up front so the pool reads ahead while earlier ones are written
+        harvests = [start_harvest(pool, root_import_path, directory, inventory[directory]) for directory in directories]
+        for directory, harvest in zip(directories, harvests):
+            convert_deployment(root_import_path, directory, harvest, gps_log, depth_log)
+
+    pool.close()
+    pool.join()
 
     print 'SUCCESS: Conversion is all done.'
 
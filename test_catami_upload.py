@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Tests for catami_upload.py that run without a Catami server, the server's answers are faked.
+
+    python -m unittest test_catami_upload
+"""
+
+import os
+import sys
+import csv
+import json
+import shutil
+import tempfile
+import unittest
+
+# catami_upload parses the command line when it is imported
+sys.argv = [sys.argv[0], '--validate']
+import catami_upload
+
+
+deployment_url = '/api/dev/deployment/7/'
+
+
+class FakeResponse(object):
+    """ the parts of a requests response catami_upload looks at
+    """
+    def __init__(self, status_code, objects=None):
+        self.status_code = status_code
+        self.text = json.dumps(dict(objects=objects or []))
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def image_row(image_name):
+    """ an images.csv row
+    """
+    return ['2013-05-01 10:00:00', '-33.8', '151.2', '20.0', image_name, 'Cam', 'Downward',
+            '18.0', '35.0', '0.0', '0.0', '0.0', '2.0', '0.5']
+
+
+class DeltaDeadLettersTest(unittest.TestCase):
+    """ a --delta upload keeps the failures recorded by earlier uploads
+    """
+
+    def setUp(self):
+        self.deployment_path = tempfile.mkdtemp()
+
+        with open(os.path.join(self.deployment_path, catami_upload.images_filename), 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Time', 'Latitude', 'Longitude', 'Depth', 'ImageName', 'CameraName', 'CameraAngle',
+                             'Temperature', 'Salinity', 'Pitch', 'Roll', 'Yaw', 'Altitude', 'DepthUncertainty'])
+            writer.writerow(['yyyy-mm-dd hh:mm:ss'] + [''] * 13)
+            for image_name in ['old.jpg', 'stuck.jpg', 'new_good.jpg', 'new_bad.jpg']:
+                writer.writerow(image_row(image_name))
+
+        image_data = catami_upload.read_images_file(self.deployment_path)
+        snapshot = {}
+        for current_image in image_data[:2]:
+            snapshot[current_image['image_name']] = dict(row_hash=catami_upload.image_row_hash(current_image),
+                                                         image='/api/dev/image/%s/' % current_image['image_name'],
+                                                         camera='/api/dev/camera/1/',
+                                                         measurement='/api/dev/measurements/1/')
+        catami_upload.write_snapshot(self.deployment_path, deployment_url, snapshot)
+
+        # stuck.jpg failed in the first upload
+        image_list_for_posting = [dict(image_name='old.jpg', deployment='7'),
+                                  dict(image_name='stuck.jpg', deployment='7')]
+        results = {0: dict(status=True, status_code=201, response='', attempts=1),
+                   1: dict(status=False, status_code=500, response='server error', attempts=3)}
+        catami_upload.write_dead_letters(self.deployment_path, image_list_for_posting, results)
+
+        self.saved = dict(patch=catami_upload.requests.patch,
+                          scan_deployment=catami_upload.scan_deployment,
+                          post_image_task=catami_upload.post_image_task,
+                          upload_images=catami_upload.upload_images)
+
+        def patch(url, data=None, **kwargs):
+            objects = json.loads(data)['objects']
+            return FakeResponse(202, [dict(resource_uri='/api/dev/image/%d/' % index) for index in range(len(objects))])
+
+        def post_image_task(task):
+            index, post_package = task
+            return index, dict(status=True, status_code=201, response='', attempts=1)
+
+        def upload_images(image_list_for_posting):
+            results = {}
+            for index, post_package in enumerate(image_list_for_posting):
+                if post_package['image_name'] == 'new_bad.jpg':
+                    results[index] = dict(status=False, status_code=None, response='timed out', attempts=3)
+                else:
+                    results[index] = dict(status=True, status_code=201, response='', attempts=1)
+            return results
+
+        catami_upload.requests.patch = patch
+        catami_upload.scan_deployment = lambda deployment_path: None
+        catami_upload.post_image_task = post_image_task
+        catami_upload.upload_images = upload_images
+
+    def tearDown(self):
+        catami_upload.requests.patch = self.saved['patch']
+        catami_upload.scan_deployment = self.saved['scan_deployment']
+        catami_upload.post_image_task = self.saved['post_image_task']
+        catami_upload.upload_images = self.saved['upload_images']
+        shutil.rmtree(self.deployment_path)
+
+    def test_old_dead_letters_survive_delta_add(self):
+        status = catami_upload.delta_sync_deployment(self.deployment_path, 'http://catami.example', 'user', 'key')
+
+        self.assertFalse(status)
+        dead_letters = catami_upload.read_dead_letters(self.deployment_path)
+        self.assertEqual(['stuck.jpg', 'new_bad.jpg'], [dead_letter['image_name'] for dead_letter in dead_letters])
+        self.assertEqual('server error', dead_letters[0]['response'])
+        self.assertEqual('timed out', dead_letters[1]['response'])
+
+
+if __name__ == '__main__':
+    unittest.main()